@@ -18,6 +18,8 @@ fi
 
 echo "building TMOS Image Patcher"
 docker build --rm ${CACHE_OPTION} -t ${DOCKER_REPO}tmos_image_patcher:latest tmos_image_patcher
+echo "building TMOS image block delta applier"
+docker build --rm ${CACHE_OPTION} -t ${DOCKER_REPO}tmos_image_delta:latest tmos_image_delta
 echo "building TMOS config drive builder"
 docker build --rm ${CACHE_OPTION} -t ${DOCKER_REPO}tmos_configdrive_builder:latest tmos_configdrive_builder
 echo "building IBM public cloud object storage uploader"
@@ -401,6 +401,21 @@ def patch_images():
         os.path.dirname(__file__), '..',
         'image_patch_files/cloudinit_configs/ibmcloud_vpc_gen2/cloud-init.tmpl'
     )
+    s_env['TMOS_PLATFORM_DEFAULTS'] = os.path.join(
+        os.path.dirname(__file__), '..',
+        'image_patch_files/platform_defaults/ibmcloud_vpc_gen2.yaml')
+    cmd = os.path.join(os.path.dirname(__file__), '..', 'tmos_image_patcher',
+                       'tmos_image_patcher.py')
+    proc = subprocess.Popen(cmd,
+                            env=s_env,
+                            stdout=sys.stdout,
+                            stderr=sys.stderr)
+    proc.wait()
+
+
+def verify_images():
+    s_env = os.environ.copy()
+    s_env['PATCHER_MODE'] = 'verify'
     cmd = os.path.join(os.path.dirname(__file__), '..', 'tmos_image_patcher',
                        'tmos_image_patcher.py')
     proc = subprocess.Popen(cmd,
@@ -408,6 +423,8 @@ def patch_images():
                             stdout=sys.stdout,
                             stderr=sys.stderr)
     proc.wait()
+    if proc.returncode != 0:
+        raise Exception('patched TMOS images failed manifest verification')
 
 
 def upload_images():
@@ -505,6 +522,8 @@ if __name__ == "__main__":
                 if cos_resources_created:
                     LOG.info('patching TMOS Images')
                     patch_images()
+                    LOG.info('verifying patched TMOS images')
+                    verify_images()
                     LOG.info('uploading TMOS images to IBM COS')
                     upload_images()
                     LOG.info('importing COS images to VPC custom images')
@@ -39,6 +39,22 @@ LOG_FILE = '/var/log/f5-cloudinit.log'
 
 VENDOR_DATA_RAW_FILE = '/opt/cloud/instance/vendor-data.txt.i'
 
+PLATFORM_FILE = '/PLATFORM'
+BIGDB_FILE = '/config/BigDB.dat'
+# written by the image patcher from its platform defaults file
+PLATFORM_DEFAULTS_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'platform_defaults.json')
+# used when the image was patched without platform defaults
+PLATFORM_DEFAULTS = {
+    # force /PLATFORM to KVM generic
+    'platform': "platform=Z100\nfamily=0xC0000000\nhost=Z100\nsystype=0x71\n",
+    # force more memory for control plane sevices to complete
+    'db': {
+        'provision.extramb': '500',
+        'restjavad.useextramb': 'true'
+    }
+}
+
 tmos_onboard_utils.touch_file(LOG_FILE)
 
 LOG = logging.getLogger(MODULE_NAME)
@@ -50,15 +66,61 @@ LOGFILE.setLevel(logging.DEBUG)
 LOGFILE.setFormatter(FORMATTER)
 LOG.addHandler(LOGFILE)
 
+
+def read_bigdb_values(bigdb_file):
+    """Read variable values from a BigDB.dat file without mcpd"""
+    values = {}
+    if not os.path.exists(bigdb_file):
+        return values
+    section = None
+    with open(bigdb_file, 'r') as bigdb:
+        for line in bigdb:
+            line = line.strip()
+            if line.startswith('[') and line.endswith(']'):
+                section = line[1:-1].lower()
+            elif section and line.lower().startswith('value='):
+                values[section] = line[len('value='):]
+    return values
+
+
+def read_platform_defaults(defaults_file):
+    """Read the platform defaults the image patcher baked into the image"""
+    if not os.path.exists(defaults_file):
+        LOG.debug('no platform defaults were baked into this image')
+        return PLATFORM_DEFAULTS
+    try:
+        with open(defaults_file, 'r') as defaults:
+            return json.load(defaults)
+    except (IOError, ValueError) as err:
+        LOG.error('could not read platform defaults %s: %s',
+                  defaults_file, err)
+        return PLATFORM_DEFAULTS
+
+
+def apply_platform_defaults():
+    """Verify platform defaults baked in at patch time, applying any changed"""
+    defaults = read_platform_defaults(PLATFORM_DEFAULTS_FILE)
+    platform = defaults.get('platform')
+    current_platform = None
+    if os.path.exists(PLATFORM_FILE):
+        with open(PLATFORM_FILE, 'r') as platform_file:
+            current_platform = platform_file.read()
+    if platform and current_platform != platform:
+        LOG.debug('forcing %s to platform defaults', PLATFORM_FILE)
+        with open(PLATFORM_FILE, 'w') as platform_file:
+            platform_file.write(platform)
+    bigdb_values = read_bigdb_values(BIGDB_FILE)
+    for (db_key, db_value) in sorted((defaults.get('db') or {}).items()):
+        if bigdb_values.get(db_key.lower()) != db_value:
+            LOG.debug('setting db variable %s to %s', db_key, db_value)
+            tmos_onboard_utils.run_cmd(
+                "/usr/bin/setdb %s %s" % (db_key, db_value))
+
+
 def handle(name, cloud_config, cloud, log, args):
     """Cloud-init processing function"""
     tag = MODULE_NAME
-    # force /PLATFORM to KVM generic
-    with open('/PLATFORM', 'w') as platform:
-        platform.write("platform=Z100\nfamily=0xC0000000\nhost=Z100\nsystype=0x71\n")
-    # force more memory for control plane sevices to complete
-    tmos_onboard_utils.run_cmd("/usr/bin/setdb provision.extramb 500")
-    tmos_onboard_utils.run_cmd("/usr/bin/setdb restjavad.useextramb true")
+    apply_platform_defaults()
     # find SSH key in vendor_data file
     if os.path.exists(VENDOR_DATA_RAW_FILE):
         LOG.debug('attempting to extract SSH key from vendor_data')
@@ -18,6 +18,7 @@
 This module supplies general onboarding utility functions
 """
 import json
+import hashlib
 import logging
 import os
 import stat
@@ -66,6 +67,7 @@ DHCP_LEASE_DIR = OUT_DIR + '/dhclient'
 
 # PKG_INSTALL_DIR = '/shared/rpms/icontrollx_installs'
 PKG_INSTALL_DIR = OUT_DIR + 'icontrollx_installs'
+PKG_PREINSTALLED_FILE = OUT_DIR + 'icontrollx_preinstalled.json'
 
 DO_DECLARATION_FILE = DO_DECLARATION_DIR + '/do_declaration.json'
 TS_DECLARATION_FILE = TS_DECLARATION_DIR + '/ts_declaration.json'
@@ -1116,13 +1118,42 @@ def get_rpm_package_name(rpm_file_path):
                             shell=True).communicate()[0].replace('\n', '')
 
 
+def get_preinstalled_extensions():
+    """Read the iControl LX packages preinstalled when the image was patched"""
+    if not os.path.isfile(PKG_PREINSTALLED_FILE):
+        return {}
+    try:
+        with open(PKG_PREINSTALLED_FILE, 'r') as preinstalled:
+            return json.load(preinstalled)
+    except Exception as err:
+        LOG.error('could not read preinstalled extensions %s: %s',
+                  PKG_PREINSTALLED_FILE, err)
+        return {}
+
+
+def is_preinstalled_extension(pkg, preinstalled):
+    """Was this exact package file preinstalled when the image was patched"""
+    if pkg not in preinstalled:
+        return False
+    pkg_hash = hashlib.sha256()
+    with open('%s/%s' % (PKG_INSTALL_DIR, pkg), 'rb') as pkg_file:
+        for block in iter(lambda: pkg_file.read(1048576), b''):
+            pkg_hash.update(block)
+    return pkg_hash.hexdigest() == preinstalled[pkg].get('sha256')
+
+
 def install_extensions(trusted_sources=True):
     """Install iControl LX package RPMs found in the RPM_INSTALL_DIR directory"""
     if not os.path.isdir(PKG_INSTALL_DIR):
         LOG.warn('No iControl LX extensions found to install')
         return False
     touch_file('/var/config/rest/iapps/enable')
+    preinstalled = get_preinstalled_extensions()
     for pkg in os.listdir(PKG_INSTALL_DIR):
+        if is_preinstalled_extension(pkg, preinstalled):
+            LOG.info('icontrol LX package %s was preinstalled in the image',
+                     pkg)
+            continue
         if wait_for_mcpd() and wait_for_rest_worker(
                 '/mgmt/shared/iapp/package-management-tasks/'):
             ext = os.path.splitext(pkg)[-1].lower()[1:]
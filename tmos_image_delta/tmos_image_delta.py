@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+This module applies block deltas written by the tmos_image_patcher to
+stock TMOS disk images, rebuilding the patched images locally.
+"""
+
+import os
+import sys
+import time
+import datetime
+import logging
+import subprocess
+import tarfile
+import hashlib
+import json
+import ctypes
+import ctypes.util
+
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL
+}
+
+QEMU_IMG_CLI = '/usr/bin/qemu-img'
+QEMU_IMG_FORMATS = {
+    '.qcow2': 'qcow2',
+    '.vhd': 'vpc',
+    '.vmdk': 'vmdk',
+    '.raw': 'raw'
+}
+
+BLOCK_DELTA_FORMAT = 'tmos-block-delta'
+BLOCK_DELTA_VERSION = 1
+
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+ZERO_BLOCK = b'\0' * HASH_BLOCK_SIZE
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+VERIFY_SOURCE = True
+
+LIBC = None
+
+LOG = logging.getLogger('tmos_image_delta')
+LOG.setLevel(logging.DEBUG)
+FORMATTER = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOGSTREAM = logging.StreamHandler(sys.stdout)
+LOGSTREAM.setFormatter(FORMATTER)
+LOG.addHandler(LOGSTREAM)
+
+
+def apply_delta(source_image, delta_file, output_image):
+    """Rebuild a patched image from a stock image and its block delta
+
+    The stock image is exported to a sparse raw image. Each changed
+    extent is checked against its SHA-256 and written over it, and the
+    extent digests are checked against the delta's merkle root before the
+    raw image is converted to the format of the output image.
+    """
+    output_format = QEMU_IMG_FORMATS.get(os.path.splitext(output_image)[1])
+    if not output_format:
+        LOG.error('unsupported output image format for %s', output_image)
+        return False
+    with tarfile.open(delta_file, 'r') as delta_tar:
+        delta = json.loads(
+            delta_tar.extractfile('delta.json').read().decode('utf-8'))
+        if delta.get('format') != BLOCK_DELTA_FORMAT or delta.get(
+                'version') != BLOCK_DELTA_VERSION:
+            LOG.error('%s is not a version %d block delta', delta_file,
+                      BLOCK_DELTA_VERSION)
+            return False
+        if VERIFY_SOURCE:
+            LOG.info('verifying source image %s', source_image)
+            source_sha256 = file_sha256(source_image)
+            if source_sha256 != delta['source']['sha256']:
+                LOG.error('%s does not match the delta source image %s',
+                          source_image, delta['source']['image'])
+                return False
+        if merkle_root([e['sha256'] for e in delta['extents']
+                        ]) != delta['merkle_root']:
+            LOG.error('extent digests in %s do not match its merkle root',
+                      delta_file)
+            return False
+        raw_image = "%s.applying" % output_image
+        LOG.info('exporting %s to raw image %s', source_image, raw_image)
+        subprocess.check_call([
+            QEMU_IMG_CLI, 'convert', '-O', 'raw',
+            os.path.abspath(source_image),
+            os.path.abspath(raw_image)
+        ])
+        try:
+            extents_data = delta_tar.extractfile('extents.bin')
+            with open(raw_image, 'r+b') as raw:
+                if os.fstat(raw.fileno()).st_size != delta['virtual_size']:
+                    raise ValueError(
+                        "%s has a virtual size of %d, the delta expects %d" %
+                        (source_image, os.fstat(raw.fileno()).st_size,
+                         delta['virtual_size']))
+                for extent in delta['extents']:
+                    write_extent(raw, extent, extents_data)
+            LOG.info('applied %d changed extents', len(delta['extents']))
+            if output_format == 'raw':
+                os.rename(raw_image, output_image)
+            else:
+                LOG.info('converting to %s image %s', output_format,
+                         output_image)
+                subprocess.check_call([
+                    QEMU_IMG_CLI, 'convert', '-f', 'raw', '-O',
+                    output_format,
+                    os.path.abspath(raw_image),
+                    os.path.abspath(output_image)
+                ])
+        finally:
+            if os.path.exists(raw_image):
+                os.remove(raw_image)
+    return True
+
+
+def write_extent(raw, extent, extents_data):
+    """Write one checked block delta extent into an open raw image"""
+    extent_hash = block_delta_extent_hash(extent['offset'], extent['length'],
+                                          extent['zero'])
+    if extent['zero']:
+        zero_range(raw, extent['offset'], extent['length'])
+    else:
+        raw.seek(extent['offset'])
+        remaining = extent['length']
+        while remaining > 0:
+            block = extents_data.read(min(remaining, HASH_BLOCK_SIZE))
+            if not block:
+                raise IOError("block delta data ends in extent at %d" %
+                              extent['offset'])
+            extent_hash.update(block)
+            raw.write(block)
+            remaining -= len(block)
+    if extent_hash.hexdigest() != extent['sha256']:
+        raise ValueError("extent at %d does not match its digest" %
+                         extent['offset'])
+
+
+def zero_range(raw, offset, length):
+    """Punch a hole over a raw image range, or write zeros over it"""
+    global LIBC
+    if not LIBC:
+        LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        LIBC.fallocate.argtypes = [
+            ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong
+        ]
+    raw.flush()
+    if LIBC.fallocate(raw.fileno(), FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                      offset, length) == 0:
+        return
+    raw.seek(offset)
+    while length > 0:
+        block = ZERO_BLOCK[:min(length, HASH_BLOCK_SIZE)]
+        raw.write(block)
+        length -= len(block)
+
+
+def block_delta_extent_hash(offset, length, is_zero):
+    """Start the SHA-256 of a block delta extent from its position"""
+    extent_kind = 'data'
+    if is_zero:
+        extent_kind = 'zero'
+    return hashlib.sha256(
+        ("%d:%d:%s:" % (offset, length, extent_kind)).encode('ascii'))
+
+
+def merkle_root(digests):
+    """Root of a SHA-256 hash tree over hex digests paired in order"""
+    if not digests:
+        return hashlib.sha256(b'').hexdigest()
+    level = list(digests)
+    while len(level) > 1:
+        parents = []
+        for index in range(0, len(level) - 1, 2):
+            pair = level[index] + level[index + 1]
+            parents.append(hashlib.sha256(pair.encode('ascii')).hexdigest())
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+
+def file_sha256(file_path):
+    """SHA-256 hex digest of a local file"""
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as file_stream:
+        for block in iter(lambda: file_stream.read(HASH_BLOCK_SIZE), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+if __name__ == "__main__":
+    START_TIME = time.time()
+    log_level = os.getenv('LOG_LEVEL', 'info')
+    if log_level.lower() in LOG_LEVELS:
+        LOG.setLevel(LOG_LEVELS[log_level.lower()])
+    LOG.debug(
+        'process start time: %s',
+        datetime.datetime.fromtimestamp(START_TIME).strftime(
+            "%A, %B %d, %Y %I:%M:%S"))
+    SOURCE_IMAGE = os.getenv('SOURCE_IMAGE', None)
+    DELTA_FILE = os.getenv('DELTA_FILE', None)
+    OUTPUT_IMAGE = os.getenv('OUTPUT_IMAGE', None)
+    VERIFY_SOURCE = os.getenv('VERIFY_SOURCE', 'true').lower() in [
+        '1', 'yes', 'true'
+    ]
+    if len(sys.argv) > 1:
+        SOURCE_IMAGE = sys.argv[1]
+    if len(sys.argv) > 2:
+        DELTA_FILE = sys.argv[2]
+    if len(sys.argv) > 3:
+        OUTPUT_IMAGE = sys.argv[3]
+    if not (SOURCE_IMAGE and DELTA_FILE and OUTPUT_IMAGE):
+        LOG.error(
+            "Set environment variables SOURCE_IMAGE, DELTA_FILE and OUTPUT_IMAGE or supply them as arguments to the script."
+        )
+        sys.exit(1)
+    for REQUIRED_FILE in [SOURCE_IMAGE, DELTA_FILE]:
+        if not os.path.exists(REQUIRED_FILE):
+            LOG.error("%s does not exist.", REQUIRED_FILE)
+            sys.exit(1)
+    LOG.info('applying block delta %s to %s', DELTA_FILE, SOURCE_IMAGE)
+    if not apply_delta(SOURCE_IMAGE, DELTA_FILE, OUTPUT_IMAGE):
+        sys.exit(1)
+    LOG.info('patched image written to %s', OUTPUT_IMAGE)
+    STOP_TIME = time.time()
+    DURATION = STOP_TIME - START_TIME
+    DURATION = str(datetime.timedelta(seconds=DURATION))
+    LOG.debug(
+        'process end time: %s - ran %s',
+        datetime.datetime.fromtimestamp(STOP_TIME).strftime(
+            "%A, %B %d, %Y %I:%M:%S"), DURATION)
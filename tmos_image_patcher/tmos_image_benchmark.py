@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+
+# coding=utf-8
+# pylint: disable=broad-except,unused-argument,line-too-long, unused-variable
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+This module benchmarks the tmos_image_patcher against small synthetic
+TMOS disk images, so patcher changes can be measured without F5 archives.
+"""
+
+import os
+import sys
+import time
+import datetime
+import logging
+import subprocess
+import zipfile
+import shutil
+import json
+import guestfs
+
+import tmos_image_patcher as patcher
+
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL
+}
+
+BENCH_VOLUME_GROUP = 'vg-db-sda'
+BENCH_LOGICAL_VOLUMES = [
+    'set.1._config', 'set.1._usr', 'set.1._var', 'dat.share', 'set.1.root'
+]
+BENCH_IMAGE_DIRS = {
+    'set.1._usr': [
+        '/lib/python2.7/site-packages/cloudinit/config',
+        '/share/defaults/config/templates'
+    ],
+    'set.1._var': ['/lib/cloud', '/config/rest/iapps'],
+    'set.1._config': [],
+    'dat.share': [],
+    'set.1.root': []
+}
+BENCH_BIGDB = """[provision.extramb]
+default=0
+type=integer
+realm=local
+value=0
+"""
+BENCH_OVF = """<?xml version="1.0" encoding="UTF-8"?>
+<Envelope xmlns="http://schemas.dmtf.org/ovf/envelope/1" xmlns:ovf="http://schemas.dmtf.org/ovf/envelope/1">
+  <References>
+    <File ovf:href="%(disk)s" ovf:id="file1"/>
+  </References>
+  <DiskSection>
+    <Info>Virtual disk information</Info>
+    <Disk ovf:capacity="%(capacity)d" ovf:capacityAllocationUnits="byte" ovf:diskId="vmdisk1" ovf:fileRef="file1"/>
+  </DiskSection>
+  <VirtualSystem ovf:id="%(name)s">
+    <Info>Synthetic TMOS benchmark image</Info>
+  </VirtualSystem>
+</Envelope>
+"""
+BENCH_FORMATS = ['qcow2']
+BENCH_SCENARIOS = ['serial']
+BENCH_IMAGES_MARKER = 'bench_images.json'
+BENCH_INJECT_MARKER = 'bench_inject.json'
+BENCH_REPORT_FILE = 'benchmark_report.json'
+
+LOG = logging.getLogger('tmos_image_benchmark')
+LOG.setLevel(logging.DEBUG)
+FORMATTER = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOGSTREAM = logging.StreamHandler(sys.stdout)
+LOGSTREAM.setFormatter(FORMATTER)
+LOG.addHandler(LOGSTREAM)
+
+
+def create_bench_images(images_dir, image_count, image_formats, lv_size_mb,
+                        fill_mb):
+    """Create synthetic TMOS image archives, reusing those already built
+
+    Each image carries a volume group with logical volumes named like the
+    TMOS _config, _usr, _var, share and root volumes, with fill_mb of
+    random data in the _usr volume. Images are packaged the way F5
+    releases them, as .qcow2.zip, .vhd.zip and .ova archives.
+    """
+    params = {
+        'image_count': image_count,
+        'image_formats': image_formats,
+        'lv_size_mb': lv_size_mb,
+        'fill_mb': fill_mb
+    }
+    marker_path = os.path.join(images_dir, BENCH_IMAGES_MARKER)
+    if os.path.exists(marker_path):
+        with open(marker_path, 'r') as marker_file:
+            marker = json.load(marker_file)
+        if marker['params'] == params:
+            LOG.info('reusing synthetic images in %s', images_dir)
+            return marker['archives']
+    if os.path.exists(images_dir):
+        shutil.rmtree(images_dir)
+    os.makedirs(images_dir)
+    raw_image = os.path.join(images_dir, 'synthetic.raw')
+    create_synthetic_image(raw_image, lv_size_mb, fill_mb)
+    archives = []
+    for index in range(image_count):
+        for image_format in image_formats:
+            image_name = "BIGIP-0.0.%d-0.0.1" % index
+            archives.append(
+                package_image(raw_image, images_dir, image_name,
+                              image_format))
+    os.remove(raw_image)
+    with open(marker_path, 'w') as marker_file:
+        json.dump({'params': params, 'archives': archives}, marker_file)
+    return archives
+
+
+def create_synthetic_image(raw_image, lv_size_mb, fill_mb):
+    """Build a raw disk with TMOS named LVM volumes using guestfs"""
+    LOG.info('creating synthetic TMOS disk image %s', raw_image)
+    fill_file = "%s.fill" % raw_image
+    with open(fill_file, 'wb') as fill:
+        for _ in range(fill_mb):
+            fill.write(os.urandom(1024 * 1024))
+    disk_size = (len(BENCH_LOGICAL_VOLUMES) * lv_size_mb + 16) * 1024 * 1024
+    gfs = guestfs.GuestFS(python_return_dict=True)
+    try:
+        gfs.disk_create(raw_image, 'raw', disk_size)
+        gfs.add_drive_opts(raw_image, format='raw')
+        gfs.launch()
+        gfs.part_disk('/dev/sda', 'mbr')
+        gfs.pvcreate('/dev/sda1')
+        gfs.vgcreate(BENCH_VOLUME_GROUP, ['/dev/sda1'])
+        for logical_volume in BENCH_LOGICAL_VOLUMES:
+            device = "/dev/%s/%s" % (BENCH_VOLUME_GROUP, logical_volume)
+            gfs.lvcreate(logical_volume, BENCH_VOLUME_GROUP, lv_size_mb)
+            gfs.mkfs('ext3', device)
+            gfs.mount(device, '/')
+            for image_dir in BENCH_IMAGE_DIRS[logical_volume]:
+                gfs.mkdir_p(image_dir)
+            if logical_volume == 'set.1._config':
+                gfs.write('/BigDB.dat', BENCH_BIGDB)
+            if logical_volume == 'set.1._usr' and fill_mb:
+                gfs.upload(fill_file, '/bench.fill')
+            gfs.umount('/')
+        gfs.sync()
+        gfs.shutdown()
+    finally:
+        gfs.close()
+        os.remove(fill_file)
+
+
+def package_image(raw_image, images_dir, image_name, image_format):
+    """Package a raw synthetic image as an F5 style release archive"""
+    if image_format == 'ova':
+        disk_image = os.path.join(images_dir, "%s.vmdk" % image_name)
+        qemu_img_convert(raw_image, disk_image, 'vmdk',
+                         'subformat=streamOptimized')
+        ovf_file = os.path.join(images_dir, "%s.ovf" % image_name)
+        with open(ovf_file, 'w') as ovf:
+            ovf.write(BENCH_OVF % {
+                'disk': os.path.basename(disk_image),
+                'capacity': os.path.getsize(raw_image),
+                'name': image_name
+            })
+        archive_file = os.path.join(images_dir, "%s.ova" % image_name)
+        with open(archive_file, 'wb') as ova_out:
+            ova_writer = patcher.OVAWriter(patcher.HashingWriter(ova_out))
+            ova_writer.add(ovf_file)
+            ova_writer.add(disk_image)
+            ova_writer.add_manifest("%s.mf" % image_name)
+            ova_writer.close()
+        os.remove(ovf_file)
+    else:
+        disk_image = os.path.join(images_dir,
+                                  "%s.%s" % (image_name, image_format))
+        qemu_img_convert(raw_image, disk_image,
+                         patcher.QEMU_IMG_FORMATS[".%s" % image_format])
+        archive_file = "%s.zip" % disk_image
+        with zipfile.ZipFile(archive_file, 'w',
+                             zipfile.ZIP_DEFLATED) as archive:
+            archive.write(disk_image, os.path.basename(disk_image))
+    os.remove(disk_image)
+    LOG.info('packaged synthetic image archive %s', archive_file)
+    return os.path.basename(archive_file)
+
+
+def qemu_img_convert(source_image, dest_image, output_format, options=None):
+    """Convert the raw synthetic image to a release disk format"""
+    convert_cmd = [
+        patcher.QEMU_IMG_CLI, 'convert', '-f', 'raw', '-O', output_format
+    ]
+    if options:
+        convert_cmd.extend(['-o', options])
+    convert_cmd.extend([source_image, dest_image])
+    subprocess.check_call(convert_cmd)
+
+
+def create_inject_trees(inject_root, file_count, file_kb):
+    """Create usr, var, config and shared inject directories of random files
+
+    The directories are reused for as long as the file count and size
+    are unchanged, so repeated benchmarks inject the same content.
+    """
+    inject_dirs = {}
+    for file_system in ['usr', 'var', 'config', 'shared']:
+        inject_dirs[file_system] = os.path.join(inject_root, file_system)
+    params = {'file_count': file_count, 'file_kb': file_kb}
+    marker_path = os.path.join(inject_root, BENCH_INJECT_MARKER)
+    if os.path.exists(marker_path):
+        with open(marker_path, 'r') as marker_file:
+            if json.load(marker_file) == params:
+                LOG.info('reusing inject directories in %s', inject_root)
+                return inject_dirs
+    if os.path.exists(inject_root):
+        shutil.rmtree(inject_root)
+    for inject_dir in inject_dirs.values():
+        bench_dir = os.path.join(inject_dir, 'bench')
+        os.makedirs(bench_dir)
+        for index in range(file_count):
+            with open(os.path.join(bench_dir, "bench_%04d" % index),
+                      'wb') as inject_file:
+                inject_file.write(os.urandom(file_kb * 1024))
+    with open(marker_path, 'w') as marker_file:
+        json.dump(params, marker_file)
+    return inject_dirs
+
+
+def run_scenario(bench_dir, images_dir, archives, inject_dirs, scenario,
+                 run_index, tmos_cloudinit_dir, cloud_template_file,
+                 patch_workers):
+    """Patch fresh copies of the synthetic archives and measure the run
+
+    Returns the run duration, image throughput, appliance launches and
+    per phase totals taken from the patcher build report.
+    """
+    run_dir = os.path.join(bench_dir, "run-%s-%d" % (scenario, run_index))
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+    archive_bytes = 0
+    for archive in archives:
+        shutil.copyfile(os.path.join(images_dir, archive),
+                        os.path.join(run_dir, archive))
+        archive_bytes += os.path.getsize(os.path.join(run_dir, archive))
+    workers = 1
+    if scenario == 'parallel':
+        workers = patch_workers
+    report_file = os.path.join(run_dir, patcher.BUILD_REPORT_FILE)
+    LOG.info('running benchmark scenario %s run %d', scenario, run_index)
+    started = patcher.MONOTONIC()
+    patcher.patch_images(run_dir, tmos_cloudinit_dir, inject_dirs['usr'],
+                         inject_dirs['var'], inject_dirs['config'],
+                         inject_dirs['shared'], None, None,
+                         cloud_template_file, True, None, workers,
+                         scenario == 'overlay', report_file=report_file)
+    duration = patcher.MONOTONIC() - started
+    with open(report_file, 'r') as rf:
+        build_report = json.load(rf)
+    phases = {}
+    for (phase_name, total) in build_report['totals'].items():
+        phase = dict(total)
+        phase['mb_per_second'] = 0.0
+        if total['duration']:
+            phase['mb_per_second'] = round(
+                (total['bytes_read'] + total['bytes_written']) /
+                (1024.0 * 1024.0) / total['duration'], 3)
+        phases[phase_name] = phase
+    result = {
+        'scenario': scenario,
+        'run': run_index,
+        'patch_workers': workers,
+        'images': len(build_report['images']),
+        'failed': build_report['failed'],
+        'archive_bytes': archive_bytes,
+        'duration': round(duration, 3),
+        'mb_per_second': round(
+            archive_bytes / (1024.0 * 1024.0) / duration, 3),
+        'appliance_launches': sum(
+            [p['appliance_launches'] for p in phases.values()]),
+        'phases': phases
+    }
+    shutil.rmtree(run_dir)
+    LOG.info(
+        'scenario %s run %d: %d images in %.3fs, %.3f MB/s, '
+        '%d appliance launches', scenario, run_index, result['images'],
+        result['duration'], result['mb_per_second'],
+        result['appliance_launches'])
+    for phase_name in sorted(phases):
+        LOG.info('    %-14s %9.3fs %9.3f MB/s %4d launches', phase_name,
+                 phases[phase_name]['duration'],
+                 phases[phase_name]['mb_per_second'],
+                 phases[phase_name]['appliance_launches'])
+    return result
+
+
+if __name__ == "__main__":
+    START_TIME = time.time()
+    if not os.environ['USER'] == 'root':
+        print("Please run this script as sudo")
+        sys.exit(1)
+    log_level = os.getenv('LOG_LEVEL', 'info')
+    if log_level.lower() in LOG_LEVELS:
+        LOG.setLevel(LOG_LEVELS[log_level.lower()])
+        patcher.LOG.setLevel(LOG_LEVELS[log_level.lower()])
+    LOG.debug(
+        'process start time: %s',
+        datetime.datetime.fromtimestamp(START_TIME).strftime(
+            "%A, %B %d, %Y %I:%M:%S"))
+    BENCH_DIR = os.getenv('BENCH_DIR', '/TMOSImages/benchmark')
+    BENCH_IMAGES = int(os.getenv('BENCH_IMAGES', '2'))
+    BENCH_FORMATS = [
+        f.strip().lower()
+        for f in os.getenv('BENCH_FORMATS', 'qcow2').split(',') if f.strip()
+    ]
+    BENCH_LV_SIZE_MB = int(os.getenv('BENCH_LV_SIZE_MB', '64'))
+    BENCH_FILL_MB = int(os.getenv('BENCH_FILL_MB', '16'))
+    BENCH_INJECT_FILES = int(os.getenv('BENCH_INJECT_FILES', '64'))
+    BENCH_INJECT_FILE_KB = int(os.getenv('BENCH_INJECT_FILE_KB', '16'))
+    BENCH_SCENARIOS = [
+        s.strip().lower()
+        for s in os.getenv('BENCH_SCENARIOS', 'serial').split(',')
+        if s.strip()
+    ]
+    BENCH_RUNS = int(os.getenv('BENCH_RUNS', '1'))
+    BENCH_PATCH_WORKERS = int(os.getenv('BENCH_PATCH_WORKERS', '4'))
+    BENCH_REPORT = os.getenv('BENCH_REPORT', None)
+    TMOS_CLOUDINIT_DIR = os.getenv(
+        'TMOS_CLOUDINIT_DIR',
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    TMOS_CLOUDINIT_CONFIG_TEMPLATE = os.getenv(
+        'TMOS_CLOUDINIT_CONFIG_TEMPLATE',
+        "%s/image_patch_files/cloudinit_configs/default/cloud-init.tmpl" %
+        TMOS_CLOUDINIT_DIR)
+    if len(sys.argv) > 1:
+        BENCH_DIR = sys.argv[1]
+    for BENCH_FORMAT in BENCH_FORMATS:
+        if BENCH_FORMAT not in ['qcow2', 'vhd', 'ova']:
+            LOG.error('unsupported benchmark image format %s', BENCH_FORMAT)
+            sys.exit(1)
+    for BENCH_SCENARIO in BENCH_SCENARIOS:
+        if BENCH_SCENARIO not in ['serial', 'parallel', 'overlay']:
+            LOG.error('BENCH_SCENARIOS must be serial, parallel or overlay')
+            sys.exit(1)
+    # benchmark the local cloudinit modules, never a freshly pulled copy
+    os.environ['UPDATE_CLOUDINIT'] = 'false'
+    IMAGES_DIR = os.path.join(BENCH_DIR, 'images')
+    ARCHIVES = create_bench_images(IMAGES_DIR, BENCH_IMAGES, BENCH_FORMATS,
+                                   BENCH_LV_SIZE_MB, BENCH_FILL_MB)
+    INJECT_DIRS = create_inject_trees(os.path.join(BENCH_DIR, 'inject'),
+                                      BENCH_INJECT_FILES,
+                                      BENCH_INJECT_FILE_KB)
+    RESULTS = []
+    for BENCH_SCENARIO in BENCH_SCENARIOS:
+        for RUN_INDEX in range(BENCH_RUNS):
+            RESULTS.append(
+                run_scenario(BENCH_DIR, IMAGES_DIR, ARCHIVES, INJECT_DIRS,
+                             BENCH_SCENARIO, RUN_INDEX, TMOS_CLOUDINIT_DIR,
+                             TMOS_CLOUDINIT_CONFIG_TEMPLATE,
+                             BENCH_PATCH_WORKERS))
+    if not BENCH_REPORT:
+        BENCH_REPORT = os.path.join(BENCH_DIR, BENCH_REPORT_FILE)
+    with open(BENCH_REPORT, 'w') as REPORT_FILE:
+        json.dump(
+            {
+                'started':
+                datetime.datetime.utcfromtimestamp(START_TIME).strftime(
+                    '%Y-%m-%dT%H:%M:%SZ'),
+                'config': {
+                    'images': BENCH_IMAGES,
+                    'formats': BENCH_FORMATS,
+                    'lv_size_mb': BENCH_LV_SIZE_MB,
+                    'fill_mb': BENCH_FILL_MB,
+                    'inject_files': BENCH_INJECT_FILES,
+                    'inject_file_kb': BENCH_INJECT_FILE_KB,
+                    'cloudinit_revision':
+                    patcher.git_revision(TMOS_CLOUDINIT_DIR)
+                },
+                'runs': RESULTS
+            },
+            REPORT_FILE,
+            indent=4,
+            sort_keys=True)
+    LOG.info('benchmark report written to %s', BENCH_REPORT)
+    STOP_TIME = time.time()
+    DURATION = STOP_TIME - START_TIME
+    DURATION = str(datetime.timedelta(seconds=DURATION))
+    LOG.debug(
+        'process end time: %s - ran %s',
+        datetime.datetime.fromtimestamp(STOP_TIME).strftime(
+            "%A, %B %d, %Y %I:%M:%S"), DURATION)
@@ -31,8 +31,20 @@ import hashlib
 import time
 import logging
 import subprocess
+import multiprocessing
 import guestfs
+import yaml
 import re
+import shutil
+import json
+import collections
+import tempfile
+import errno
+import io
+import contextlib
+import uuid
+import struct
+import zlib
 
 from Crypto.Hash import SHA384
 from Crypto.Signature import PKCS1_v1_5
@@ -54,6 +66,132 @@ VBOXMANAGE_CLI_FORMAT = 'vmdk'
 VBOXMANAGE_CLI_PATCH_VARIANT = 'Standard'
 VBOXMANAGE_CLI_OUTPUT_VARIANT = 'Stream'
 
+QEMU_IMG_CLI = '/usr/bin/qemu-img'
+QEMU_IMG_FORMATS = {'.qcow2': 'qcow2', '.vhd': 'vpc', '.vmdk': 'vmdk'}
+QEMU_IMG_VMDK_SUBFORMATS = {
+    VBOXMANAGE_CLI_PATCH_VARIANT: 'monolithicSparse',
+    VBOXMANAGE_CLI_OUTPUT_VARIANT: 'streamOptimized'
+}
+QEMU_IMG_COROUTINES = 8
+
+VMDK_CONVERTER = 'auto'
+
+IMAGE_SPARSIFY = 'trim'
+QCOW2_COMPRESS = True
+OUTPUT_FORMATS = []
+
+IMAGE_PROBE = True
+PROBE_SECTOR_SIZE = 512
+MBR_SIGNATURE = b'\x55\xaa'
+MBR_EXTENDED_TYPES = [0x05, 0x0f, 0x85]
+MBR_GPT_TYPE = 0xee
+MBR_MAX_LOGICAL = 128
+GPT_SIGNATURE = b'EFI PART'
+GPT_MAX_ENTRIES = 256
+LVM_LABEL_ID = b'LABELONE'
+LVM_LABEL_TYPE = b'LVM2 001'
+LVM_LABEL_SECTORS = 4
+LVM_MDA_MAGIC = b' LVM2 x[5A%r0N*>'
+LVM_MDA_HEADER_SIZE = 512
+QCOW2_MAGIC = b'QFI\xfb'
+QCOW2_OFFSET_MASK = 0x00fffffffffffe00
+QCOW2_COMPRESSED = 1 << 62
+QCOW2_ZERO_CLUSTER = 1
+QCOW2_DIRTY = 1
+VHD_COOKIE = b'conectix'
+VHD_DYNAMIC_COOKIE = b'cxsparse'
+VHD_FIXED = 2
+VHD_DYNAMIC = 3
+VHD_UNALLOCATED = 0xffffffff
+
+BLOCK_DELTA = False
+BLOCK_DELTA_FORMAT = 'tmos-block-delta'
+BLOCK_DELTA_VERSION = 1
+
+RPM2CPIO_CLI = '/usr/bin/rpm2cpio'
+CPIO_CLI = '/bin/cpio'
+ICONTROLLX_PREINSTALL = False
+ICONTROLLX_INSTALL_DIR = '/var/lib/cloud/icontrollx_installs'
+ICONTROLLX_IAPPS_DIR = '/var/config/rest/iapps'
+ICONTROLLX_PREINSTALLED_FILE = '/var/lib/cloud/icontrollx_preinstalled.json'
+
+PRISTINE_DIR = '.pristine'
+PRISTINE_MARKER = 'pristine.json'
+
+BUILD_MATRIX_VARIANT_KEYS = [
+    'name', 'cloud_template', 'usr_inject_dir', 'var_inject_dir',
+    'shared_inject_dir', 'config_inject_dir', 'icontrollx_dir',
+    'output_suffix', 'output_formats', 'platform_defaults'
+]
+
+TMOS_FILESYSTEMS = {
+    'config': '_config',
+    'usr': '_usr',
+    'var': '_var',
+    'shared': 'share',
+    'root': '.root'
+}
+TMOS_PYTHON_VERSIONS = ['python2.6', 'python2.7']
+PYC_COMPILE_SCRIPT = """
+import sys, py_compile
+args = sys.argv[1:]
+for i in range(0, len(args), 3):
+    try:
+        py_compile.compile(args[i], args[i + 1], args[i + 2], True)
+    except Exception as ex:
+        sys.stderr.write('%s\\n' % ex)
+"""
+
+TMOS_MOUNTPOINTS = {
+    'config': '/config',
+    'usr': '/usr',
+    'var': '/var',
+    'shared': '/shared',
+    'root': '/rootfs'
+}
+
+PLATFORM_FILE = '/PLATFORM'
+BIGDB_FILE = '/config/BigDB.dat'
+PLATFORM_DEFAULTS_KEYS = ['platform', 'db']
+PLATFORM_DEFAULTS_MODULE_FILE = (
+    '/site-packages/cloudinit/config/platform_defaults.json')
+
+PATCH_WORKER_MEMORY = 1536 * 1024 * 1024
+
+APPLIANCE_POOL_MODE = 'auto'
+FIXED_APPLIANCE_DIR = None
+FIXED_APPLIANCE_FILES = ['kernel', 'initrd', 'root', 'README.fixed']
+MAKE_FIXED_APPLIANCE_CLI = 'libguestfs-make-fixed-appliance'
+HOTPLUG_SCRATCH_SIZE = 1024 * 1024
+
+VERIFY_REPORT_FILE = 'verify_report.json'
+
+BUILD_REPORT_FILE = 'build_report.json'
+PATCH_STATE_SUFFIX = '.state'
+PATCH_STATE_VERSION = 1
+# python 2.7 time module lacks a monotonic clock
+MONOTONIC = getattr(time, 'monotonic', time.time)
+
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+SPARSE_BLOCK_SIZE = 64 * 1024
+ZERO_BLOCK = b'\0' * HASH_BLOCK_SIZE
+# python 2.7 os module lacks the Linux lseek hole whence values
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+ARTIFACT_SUFFIXES = [
+    '.md5', '.sha256', '.manifest', '.384.sig', '.fingerprint', '.delta'
+]
+
+LOCAL_SHA256_CACHE = {}
+INJECT_FILE_INDEX = {}
+PYC_INDEX = {}
+ICONTROLLX_PREINSTALLS = {}
+RUN_CACHE_DIR = None
+RUN_ID = None
+ACTIVE_REPORT = None
+FIXED_APPLIANCE = None
+APPLIANCE_POOL = None
+
 DEBUG = True
 
 LOG = logging.getLogger('tmos_image_patcher')
@@ -69,99 +207,943 @@ def patch_images(tmos_image_dir, tmos_cloudinit_dir, tmos_usr_inject_dir,
                  tmos_var_inject_dir, tmos_config_inject_dir,
                  tmos_shared_inject_dir, tmos_icontrollx_dir,
                  private_pem_key_path, cloud_template_file, image_overwrite,
-                 image_build_id):
-    """Patch TMOS classic disk image"""
+                 image_build_id, patch_workers=1, patch_overlay=False,
+                 build_matrix=None, cloudinit_revision=None,
+                 platform_defaults_file=None, report_file=None):
+    """Patch TMOS classic disk image
+
+    Returns the names of the parallel workers which failed to patch their
+    archive. A failure patching archives serially is raised.
+    """
+    failed = []
     if tmos_image_dir and os.path.exists(tmos_image_dir):
-        for disk_image in scan_for_images(tmos_image_dir, image_overwrite,
-                                          image_build_id):
-            LOG.info('processing disk image: %s' % disk_image)
-            (is_tmos, config_dev, usr_dev, var_dev, shared_dev) = \
-                validate_tmos_device(disk_image)
-            if is_tmos:
-                manifest_file_path = "%s.manifest" % disk_image
-                if os.path.exists(manifest_file_path):
-                    LOG.info('deleting previous manifest file %s',
-                             manifest_file_path)
-                    os.unlink(manifest_file_path)
-                if usr_dev and tmos_cloudinit_dir:
-                    update_cloudinit = os.getenv('UPDATE_CLOUDINIT',
-                                                 default="true")
-                    if update_cloudinit == "true":
-                        update_cloudinit_modules(tmos_cloudinit_dir)
-                    inject_cloudinit_modules(disk_image, tmos_cloudinit_dir,
-                                             usr_dev)
-                if usr_dev and cloud_template_file:
-                    inject_cloudinit_config_template(disk_image,
-                                                     tmos_cloudinit_dir,
-                                                     cloud_template_file,
-                                                     usr_dev)
-                if usr_dev and tmos_usr_inject_dir:
-                    inject_usr_files(disk_image, tmos_usr_inject_dir, usr_dev)
-                if var_dev and tmos_var_inject_dir:
-                    inject_var_files(disk_image, tmos_var_inject_dir, var_dev)
-                if var_dev and tmos_icontrollx_dir:
-                    inject_icontrollx_packages(disk_image, tmos_icontrollx_dir,
-                                               var_dev)
-                if shared_dev and tmos_shared_inject_dir:
-                    inject_shared_files(disk_image, tmos_shared_inject_dir,
-                                        shared_dev)
-                if config_dev and tmos_config_inject_dir:
-                    inject_config_files(disk_image, tmos_config_inject_dir,
-                                        config_dev)
-                if os.path.splitext(disk_image)[1] == '.vmdk':
-                    clean_up_vmdk(disk_image)
-                    disk_image = "%s/%s.ova" % (
-                        os.path.dirname(disk_image),
-                        os.path.basename(os.path.dirname(disk_image)))
-            generate_md5sum(disk_image)
-            if private_pem_key_path:
-                try:
-                    sign_image(disk_image, private_pem_key_path)
-                except Exception as ex:
-                    LOG.error("could not sign %s with private key %s: %s",
-                              disk_image, private_pem_key_path, ex)
-            if image_build_id:
-                build_split = os.path.splitext(disk_image)
-                build_name = "%s-%s%s" % (build_split[0], image_build_id, build_split[1])
-                os.rename(disk_image, build_name)
-                os.rename("%s.md5" % disk_image, "%s.md5" % build_name)
-                os.rename("%s.manifest" % disk_image, "%s.manifest" % build_name)
-                sig_file = "%s.384.sig" % disk_image
-                if os.path.exists(sig_file):
-                    os.rename(sig_file, "%s.384.sig" % build_name)
+        if tmos_cloudinit_dir:
+            update_cloudinit = os.getenv('UPDATE_CLOUDINIT', default="true")
+            if cloudinit_revision or update_cloudinit == "true":
+                if not update_cloudinit_modules(tmos_cloudinit_dir,
+                                                cloudinit_revision):
+                    LOG.error('cloudinit modules are not at revision %s, '
+                              'no images were patched', cloudinit_revision)
+                    sys.exit(1)
+            LOG.info('patching with cloudinit modules at revision %s',
+                     git_revision(tmos_cloudinit_dir))
+        patch_args = (tmos_cloudinit_dir, tmos_usr_inject_dir,
+                      tmos_var_inject_dir, tmos_config_inject_dir,
+                      tmos_shared_inject_dir, tmos_icontrollx_dir,
+                      private_pem_key_path, cloud_template_file,
+                      image_build_id, platform_defaults_file)
+        run_report = BuildReport(tmos_image_dir)
+        with active_report(run_report):
+            with report_phase('prepare'):
+                prepare_patch_run(tmos_cloudinit_dir, [
+                    tmos_usr_inject_dir, tmos_var_inject_dir,
+                    tmos_config_inject_dir, tmos_shared_inject_dir,
+                    tmos_icontrollx_dir
+                ], tmos_icontrollx_dir)
+            try:
+                with report_phase('scan', tmos_image_dir):
+                    (archives, variants) = scan_patch_run(
+                        tmos_image_dir, tmos_cloudinit_dir,
+                        cloud_template_file, tmos_usr_inject_dir,
+                        tmos_var_inject_dir, tmos_config_inject_dir,
+                        tmos_shared_inject_dir, tmos_icontrollx_dir,
+                        private_pem_key_path, image_overwrite,
+                        image_build_id, build_matrix, platform_defaults_file)
+                pristine_root = None
+                if patch_overlay or variants:
+                    pristine_root = os.path.join(tmos_image_dir,
+                                                 PRISTINE_DIR)
+                with report_phase('patch', tmos_image_dir):
+                    if patch_workers > 1 and len(archives) > 1:
+                        failed = patch_archives_parallel(
+                            tmos_image_dir, archives, patch_args,
+                            patch_workers, pristine_root, variants)
+                    else:
+                        for (filepath, extract_dir,
+                             fingerprint) in archives:
+                            patch_archive(filepath, extract_dir,
+                                          fingerprint, patch_args,
+                                          pristine_root, variants)
+            finally:
+                close_appliance_pool()
+                shutil.rmtree(RUN_CACHE_DIR, ignore_errors=True)
+        write_build_summary(tmos_image_dir, run_report, report_file, failed)
     else:
         LOG.error("TMOS image directory %s does not exist.", tmos_image_dir)
         LOG.error(
             "Set environment variable TMOS_IMAGE_DIR or supply as the first argument to the script."
         )
         sys.exit(1)
+    return failed
 
 
-def scan_for_images(tmos_image_dir, image_overwrite, image_build_id):
-    """Scan for TMOS disk images"""
-    return_image_files = []
+def scan_patch_run(tmos_image_dir, tmos_cloudinit_dir, cloud_template_file,
+                   tmos_usr_inject_dir, tmos_var_inject_dir,
+                   tmos_config_inject_dir, tmos_shared_inject_dir,
+                   tmos_icontrollx_dir, private_pem_key_path, image_overwrite,
+                   image_build_id, build_matrix=None,
+                   platform_defaults_file=None):
+    """Fingerprint the patch inputs and find the archives to patch
+
+    Returns the archives and the build matrix variants, if any.
+    """
+    input_fingerprints = fingerprint_inputs(
+        tmos_cloudinit_dir, cloud_template_file, {
+            'usr': tmos_usr_inject_dir,
+            'var': tmos_var_inject_dir,
+            'config': tmos_config_inject_dir,
+            'shared': tmos_shared_inject_dir,
+            'icontrollx': tmos_icontrollx_dir
+        }, private_pem_key_path, platform_defaults_file)
+    if build_matrix:
+        variants = load_build_matrix(build_matrix)
+        for variant in variants:
+            # unpack before workers fork so they share the payloads
+            if ICONTROLLX_PREINSTALL and variant.get('icontrollx_dir'):
+                icontrollx_preinstalls(variant['icontrollx_dir'])
+        return (scan_for_variant_archives(tmos_image_dir, image_overwrite,
+                                          image_build_id, input_fingerprints,
+                                          variants), variants)
+    return (scan_for_archives(tmos_image_dir, image_overwrite,
+                              image_build_id, input_fingerprints), None)
+
+
+def prepare_patch_run(tmos_cloudinit_dir, inject_dirs, icontrollx_dir=None):
+    """Index and hash the local patch inputs once before patching
+
+    Inject directories are walked and their files hashed once. Inject tar
+    bundles built from them are kept in a run cache directory. Patch
+    workers are forked after this stage, so they share the index, the
+    digests, the bundles and the fixed guestfs appliance.
+    """
+    global RUN_CACHE_DIR, RUN_ID, FIXED_APPLIANCE, APPLIANCE_POOL
+    RUN_CACHE_DIR = tempfile.mkdtemp(prefix='tmos_patch_run_')
+    RUN_ID = uuid.uuid4().hex
+    APPLIANCE_POOL = None
+    FIXED_APPLIANCE = None
+    if APPLIANCE_POOL_MODE != 'none' and FIXED_APPLIANCE_DIR:
+        FIXED_APPLIANCE = prepare_fixed_appliance(FIXED_APPLIANCE_DIR)
+    INJECT_FILE_INDEX.clear()
+    PYC_INDEX.clear()
+    ICONTROLLX_PREINSTALLS.clear()
+    if tmos_cloudinit_dir:
+        inject_dirs = inject_dirs + [
+            "%s/image_patch_files/system_python_path" % tmos_cloudinit_dir
+        ]
+        precompile_cloudinit_modules(tmos_cloudinit_dir)
+    for inject_dir in inject_dirs:
+        if inject_dir and os.path.isdir(inject_dir):
+            inject_files = list_inject_files(inject_dir)
+            for inject_file in inject_files:
+                local_file_sha256("%s%s" % (inject_dir, inject_file))
+            LOG.debug('indexed %d inject files in %s', len(inject_files),
+                      inject_dir)
+    if ICONTROLLX_PREINSTALL and icontrollx_dir and os.path.isdir(
+            icontrollx_dir):
+        icontrollx_preinstalls(icontrollx_dir)
+
+
+def patch_image(disk_image, tmos_cloudinit_dir, tmos_usr_inject_dir,
+                tmos_var_inject_dir, tmos_config_inject_dir,
+                tmos_shared_inject_dir, tmos_icontrollx_dir,
+                private_pem_key_path, cloud_template_file, image_build_id,
+                platform_defaults_file=None, fingerprint=None,
+                pristine_image=None, archive_report=None):
+    """Patch a single extracted TMOS disk image
+
+    With a pristine image, the patches are written to a thin qcow2 overlay
+    backed by the read-only pristine image, and the overlay is flattened
+    into disk_image once patching is complete. Free space is trimmed or
+    zeroed after injection, and qcow2 images are rewritten compressed.
+    Any further OUTPUT_FORMATS are converted from the same image. With
+    BLOCK_DELTA, the blocks the overlay changed are also written as a
+    block delta against the pristine image. Each phase is timed into a
+    build report written next to the image. Completed phases are recorded
+    in the image's patch state, and phases already completed with the
+    same inputs by a stopped run are skipped.
+    """
+    report = BuildReport(disk_image, archive_report)
+    state = PatchState(disk_image, fingerprint and fingerprint['fingerprint'])
+    with active_report(report):
+        LOG.info('processing disk image: %s' % disk_image)
+        drive = disk_image
+        drive_format = None
+        if pristine_image:
+            drive = "%s.overlay" % disk_image
+            drive_format = 'qcow2'
+        is_tmos = state.done('injected')
+        if is_tmos:
+            LOG.info('resuming %s after patch input injection', disk_image)
+        else:
+            resumed = state.done('patching')
+            if pristine_image and not (resumed and os.path.exists(drive)):
+                create_overlay(pristine_image, drive)
+                resumed = False
+            state.record('patching')
+            with TMOSImageSession(disk_image, drive, drive_format,
+                                  state=state, resumed=resumed) as session:
+                if session.is_tmos:
+                    manifest_file_path = "%s.manifest" % disk_image
+                    if os.path.exists(manifest_file_path):
+                        LOG.info('deleting previous manifest file %s',
+                                 manifest_file_path)
+                        os.unlink(manifest_file_path)
+                    with report_phase('stage', disk_image):
+                        session.mount()
+                        inject_patch_inputs(session, tmos_cloudinit_dir,
+                                            cloud_template_file,
+                                            tmos_usr_inject_dir,
+                                            tmos_var_inject_dir,
+                                            tmos_icontrollx_dir,
+                                            tmos_shared_inject_dir,
+                                            tmos_config_inject_dir,
+                                            platform_defaults_file)
+                    session.flush()
+                    session.sparsify(IMAGE_SPARSIFY)
+            is_tmos = session.is_tmos
+            if is_tmos:
+                state.record('injected')
+        if pristine_image:
+            if BLOCK_DELTA and is_tmos and not state.done('delta'):
+                with report_phase('delta', disk_image):
+                    write_block_delta([drive], pristine_image,
+                                      "%s.delta" % disk_image)
+                state.record('delta')
+            if not state.done('flattened'):
+                flatten_overlay(drive, disk_image)
+                state.record('flattened')
+            if os.path.exists(drive):
+                os.remove(drive)
+        elif is_tmos and not state.done('compacted'):
+            compact_image(disk_image)
+            state.record('compacted')
+        for output_format in OUTPUT_FORMATS:
+            output_image = "%s.%s" % (os.path.splitext(disk_image)[0],
+                                      output_format)
+            if output_image == disk_image:
+                continue
+            if not state.done("converted:%s" % output_format):
+                convert_output_image(disk_image, output_image)
+                for artifact_suffix in ['.manifest', '.delta']:
+                    if os.path.exists("%s%s" % (disk_image, artifact_suffix)):
+                        shutil.copyfile(
+                            "%s%s" % (disk_image, artifact_suffix),
+                            "%s%s" % (output_image, artifact_suffix))
+                state.record("converted:%s" % output_format)
+            report.artifacts.append(
+                finalize_image(output_image, is_tmos, private_pem_key_path,
+                               image_build_id, fingerprint, state))
+        report.artifacts.append(
+            finalize_image(disk_image, is_tmos, private_pem_key_path,
+                           image_build_id, fingerprint, state))
+    report.write(report.artifact_report_file())
+    state.remove()
+
+
+def inject_patch_inputs(session, tmos_cloudinit_dir, cloud_template_file,
+                        tmos_usr_inject_dir, tmos_var_inject_dir,
+                        tmos_icontrollx_dir, tmos_shared_inject_dir,
+                        tmos_config_inject_dir, platform_defaults_file=None):
+    """Stage every configured injection for the file systems present"""
+    if session.has('usr') and tmos_cloudinit_dir:
+        inject_cloudinit_modules(session, tmos_cloudinit_dir)
+    if session.has('usr') and cloud_template_file:
+        inject_cloudinit_config_template(session, cloud_template_file)
+    if session.has('usr') and tmos_usr_inject_dir:
+        inject_usr_files(session, tmos_usr_inject_dir)
+    if session.has('var') and tmos_var_inject_dir:
+        inject_var_files(session, tmos_var_inject_dir)
+    if session.has('var') and tmos_icontrollx_dir:
+        inject_icontrollx_packages(session, tmos_icontrollx_dir)
+    if session.has('shared') and tmos_shared_inject_dir:
+        inject_shared_files(session, tmos_shared_inject_dir)
+    if session.has('config') and tmos_config_inject_dir:
+        inject_config_files(session, tmos_config_inject_dir)
+    if platform_defaults_file:
+        inject_platform_defaults(session, platform_defaults_file)
+
+
+def finalize_image(disk_image, is_tmos, private_pem_key_path, image_build_id,
+                   fingerprint=None, state=None):
+    """Package, hash, sign and name a patched disk image artifact
+
+    With a patch state, each of these phases is recorded for the artifact
+    and skipped if a stopped run already completed it. Returns the path of
+    the finished artifact.
+    """
+    artifact_name = os.path.basename(disk_image)
+    hasher = None
+    if is_tmos and os.path.splitext(disk_image)[1] == '.vmdk':
+        if state and state.done("packaged:%s" % artifact_name):
+            if not os.path.exists(disk_image):
+                disk_image = ova_image_path(disk_image)
+        else:
+            (disk_image, hasher) = clean_up_vmdk(disk_image)
+            if state:
+                state.record("packaged:%s" % artifact_name)
+    if not (state and state.done("hashed:%s" % artifact_name)):
+        hasher = generate_digest_files(disk_image, hasher)
+        if state:
+            state.record("hashed:%s" % artifact_name)
+    if private_pem_key_path and not (state and state.done(
+            "signed:%s" % artifact_name)):
+        try:
+            sign_image(disk_image, private_pem_key_path, hasher)
+            if state:
+                state.record("signed:%s" % artifact_name)
+        except Exception as ex:
+            LOG.error("could not sign %s with private key %s: %s",
+                      disk_image, private_pem_key_path, ex)
+    if fingerprint:
+        write_fingerprint(disk_image, fingerprint)
+    if image_build_id:
+        build_split = os.path.splitext(disk_image)
+        build_name = "%s-%s%s" % (build_split[0], image_build_id, build_split[1])
+        for artifact_suffix in ARTIFACT_SUFFIXES:
+            artifact_file = "%s%s" % (disk_image, artifact_suffix)
+            if os.path.exists(artifact_file):
+                move_file(artifact_file,
+                          "%s%s" % (build_name, artifact_suffix))
+        # the image is moved last, so a stopped rename can be resumed
+        if os.path.exists(disk_image):
+            move_file(disk_image, build_name)
+        if state:
+            state.record("renamed:%s" % artifact_name)
+        disk_image = build_name
+    return disk_image
+
+
+def patch_archive(filepath, extract_dir, fingerprint, patch_args,
+                  pristine_root=None, variants=None):
+    """Extract and patch all disk images from one archive
+
+    Extraction is recorded in a build report for the archive, which is
+    included in the build report of each of its images.
+    """
+    archive_report = BuildReport(filepath)
+    if variants:
+        patch_archive_variants(filepath, extract_dir, fingerprint,
+                               patch_args, pristine_root, variants,
+                               archive_report)
+    elif pristine_root:
+        if not resumable_images(extract_dir, fingerprint
+                                and fingerprint['fingerprint']):
+            remove_extracted_files(extract_dir)
+        with active_report(archive_report):
+            pristine_images = extract_pristine_images(filepath,
+                                                      pristine_root)
+        for pristine_image in pristine_images:
+            copy_pristine_descriptors(os.path.dirname(pristine_image),
+                                      extract_dir)
+            disk_image = os.path.join(extract_dir,
+                                      os.path.basename(pristine_image))
+            patch_image(disk_image, *patch_args, fingerprint=fingerprint,
+                        pristine_image=pristine_image,
+                        archive_report=archive_report)
+    else:
+        with active_report(archive_report):
+            disk_images = extract_image_archive(
+                filepath, extract_dir, fingerprint
+                and fingerprint['fingerprint'])
+        for disk_image in disk_images:
+            patch_image(disk_image, *patch_args, fingerprint=fingerprint,
+                        archive_report=archive_report)
+
+
+def patch_archive_variants(filepath, extract_dir, fingerprints, patch_args,
+                           pristine_root, variants, archive_report=None):
+    """Patch every build matrix variant of the disk images in one archive
+
+    Extraction, conversion and TMOS validation happen once per archive.
+    The cloudinit modules and the run level inject directories are
+    injected once into a common overlay of each pristine image. Each
+    variant is a thin overlay of the common overlay holding only its own
+    template and inject directories, flattened into every requested
+    output format in the variant's own output directory. The shared
+    phases are timed into the archive build report, and each variant's
+    own phases into a build report written next to its image.
+    """
+    (tmos_cloudinit_dir, tmos_usr_inject_dir, tmos_var_inject_dir,
+     tmos_config_inject_dir, tmos_shared_inject_dir, tmos_icontrollx_dir,
+     private_pem_key_path, cloud_template_file, image_build_id,
+     platform_defaults_file) = patch_args
+    with active_report(archive_report):
+        pristine_images = extract_pristine_images(filepath, pristine_root)
+    for pristine_image in pristine_images:
+        image_name = os.path.basename(pristine_image)
+        common_overlay = "%s.common.overlay" % os.path.join(
+            os.path.dirname(pristine_image), image_name)
+        common_staged = []
+        with active_report(archive_report):
+            create_overlay(pristine_image, common_overlay)
+            LOG.info('injecting common patch inputs into %s',
+                     common_overlay)
+            with TMOSImageSession(common_overlay, common_overlay, 'qcow2',
+                                  manifest=False) as session:
+                if session.is_tmos:
+                    with report_phase('stage', common_overlay):
+                        session.mount()
+                        inject_patch_inputs(session, tmos_cloudinit_dir, None,
+                                            tmos_usr_inject_dir,
+                                            tmos_var_inject_dir,
+                                            tmos_icontrollx_dir,
+                                            tmos_shared_inject_dir,
+                                            tmos_config_inject_dir)
+                    common_staged = session.flush()
+        for variant in variants:
+            if variant['name'] not in fingerprints:
+                continue
+            variant_dir = "%s-%s" % (extract_dir, variant['output_suffix'])
+            if not os.path.exists(variant_dir):
+                os.makedirs(variant_dir)
+            remove_extracted_files(variant_dir)
+            copy_pristine_descriptors(os.path.dirname(pristine_image),
+                                      variant_dir)
+            disk_image = os.path.join(variant_dir, image_name)
+            variant_report = BuildReport(disk_image, archive_report)
+            with active_report(variant_report):
+                variant_overlay = "%s.overlay" % disk_image
+                create_overlay(common_overlay, variant_overlay, 'qcow2')
+                LOG.info('patching build variant %s of %s', variant['name'],
+                         image_name)
+                with TMOSImageSession(disk_image, variant_overlay,
+                                      'qcow2') as variant_session:
+                    if variant_session.is_tmos:
+                        variant_session.add_manifest_entries(common_staged)
+                        with report_phase('stage', disk_image):
+                            variant_session.mount()
+                            inject_patch_inputs(
+                                variant_session, None,
+                                variant.get('cloud_template',
+                                            cloud_template_file),
+                                variant.get('usr_inject_dir'),
+                                variant.get('var_inject_dir'),
+                                variant.get('icontrollx_dir'),
+                                variant.get('shared_inject_dir'),
+                                variant.get('config_inject_dir'),
+                                variant.get('platform_defaults',
+                                            platform_defaults_file))
+                        variant_session.flush()
+                        variant_session.sparsify(IMAGE_SPARSIFY)
+                variant_manifest = "%s.manifest" % disk_image
+                staged_manifest = "%s.staged" % variant_manifest
+                if os.path.exists(variant_manifest):
+                    os.rename(variant_manifest, staged_manifest)
+                staged_delta = "%s.delta.staged" % disk_image
+                if BLOCK_DELTA and variant_session.is_tmos:
+                    with report_phase('delta', disk_image):
+                        write_block_delta([variant_overlay, common_overlay],
+                                          pristine_image, staged_delta)
+                output_formats = variant.get('output_formats') or [
+                    os.path.splitext(image_name)[1][1:]
+                ]
+                for output_format in output_formats:
+                    output_image = "%s.%s" % (os.path.splitext(disk_image)[0],
+                                              output_format)
+                    flatten_overlay(variant_overlay, output_image)
+                    if os.path.exists(staged_manifest):
+                        shutil.copyfile(staged_manifest,
+                                        "%s.manifest" % output_image)
+                    if os.path.exists(staged_delta):
+                        shutil.copyfile(staged_delta,
+                                        "%s.delta" % output_image)
+                    variant_report.artifacts.append(
+                        finalize_image(output_image, variant_session.is_tmos,
+                                       private_pem_key_path, image_build_id,
+                                       fingerprints[variant['name']]))
+                for staged_file in [staged_manifest, staged_delta]:
+                    if os.path.exists(staged_file):
+                        os.remove(staged_file)
+                os.remove(variant_overlay)
+            variant_report.write(variant_report.artifact_report_file())
+        os.remove(common_overlay)
+
+
+def patch_archive_worker(filepath, extract_dir, fingerprint, patch_args,
+                         pristine_root=None, variants=None):
+    """Extract and patch all disk images from one archive in a worker process"""
+    worker_name = os.path.basename(extract_dir)
+    LOGSTREAM.setFormatter(
+        logging.Formatter(
+            '%%(asctime)s - %%(name)s - [%s] - %%(levelname)s - %%(message)s'
+            % worker_name))
+    try:
+        patch_archive(filepath, extract_dir, fingerprint, patch_args,
+                      pristine_root, variants)
+    except Exception as ex:
+        LOG.error('patching %s failed: %s', filepath, ex)
+        sys.exit(1)
+    finally:
+        close_appliance_pool()
+
+
+def patch_archives_parallel(tmos_image_dir, archives, patch_args,
+                            patch_workers, pristine_root=None, variants=None):
+    """Patch archives concurrently with a bounded pool of worker processes
+
+    A worker is only admitted when the estimated extraction size fits the
+    free space on the image volume and a guestfs appliance fits in available
+    memory, after subtracting what already running workers have reserved.
+    Returns the names of the workers which did not complete patching.
+    """
+    LOG.info('patching %d archives with up to %d workers', len(archives),
+             patch_workers)
+    pending = list(archives)
+    running = {}
+    failed = []
+    while pending or running:
+        for (process, reservation) in list(running.items()):
+            if not process.is_alive():
+                process.join()
+                if process.exitcode != 0:
+                    failed.append(process.name)
+                del running[process]
+        while pending and len(running) < patch_workers:
+            (filepath, extract_dir, fingerprint) = pending[0]
+            disk_needed = estimate_extract_size(filepath)
+            disk_reserved = sum([r[0] for r in running.values()])
+            mem_reserved = sum([r[1] for r in running.values()])
+            if running and (
+                    disk_needed + disk_reserved > free_disk_bytes(
+                        tmos_image_dir)
+                    or PATCH_WORKER_MEMORY + mem_reserved >
+                    available_memory_bytes()):
+                LOG.debug('deferring %s until running workers release '
+                          'disk or memory', filepath)
+                break
+            pending.pop(0)
+            process = multiprocessing.Process(
+                target=patch_archive_worker,
+                name=os.path.basename(extract_dir),
+                args=(filepath, extract_dir, fingerprint, patch_args,
+                      pristine_root, variants))
+            process.start()
+            LOG.info('started worker %s (pid %d) for %s', process.name,
+                     process.pid, filepath)
+            running[process] = (disk_needed, PATCH_WORKER_MEMORY)
+        time.sleep(1)
+    for worker_name in failed:
+        LOG.error('worker %s did not complete patching', worker_name)
+    return failed
+
+
+def estimate_extract_size(archive_file):
+    """Estimate the disk space needed to extract and convert an archive"""
+    arch_ext = os.path.splitext(archive_file)[1]
+    size = 0
+    needs_conversion = False
+    try:
+        if ARCHIVE_EXTS.get(arch_ext) == 'zipfile':
+            archive = zipfile.ZipFile(archive_file, 'r')
+            for member in archive.infolist():
+                size += member.file_size
+                if member.filename.endswith('.vmdk'):
+                    needs_conversion = True
+            archive.close()
+        elif ARCHIVE_EXTS.get(arch_ext) == 'tarfile':
+            archive = tarfile.TarFile(archive_file, 'r')
+            for member in archive.getmembers():
+                size += member.size
+                if member.name.endswith('.vmdk'):
+                    needs_conversion = True
+            archive.close()
+        else:
+            size = os.path.getsize(archive_file)
+    except Exception as ex:
+        LOG.warn('could not list %s to estimate its size: %s', archive_file,
+                 ex)
+        size = os.path.getsize(archive_file)
+    if needs_conversion:
+        size = size * 2
+    return size
+
+
+def free_disk_bytes(path):
+    """Free bytes on the file system holding path"""
+    fs_stat = os.statvfs(path)
+    return fs_stat.f_bavail * fs_stat.f_frsize
+
+
+def available_memory_bytes():
+    """Available memory as reported by the kernel"""
+    with open('/proc/meminfo', 'r') as meminfo:
+        for line in meminfo:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return PATCH_WORKER_MEMORY
+
+
+class BuildReport(object):
+    """Phase timings and byte counts of one patch run, archive or image
+
+    Phases are timed with a monotonic clock. A phase started inside
+    another is recorded on its own and its time is left out of the
+    enclosing phase, so phase durations add up. Bytes and appliance
+    launches are counted against the innermost running phase. The report
+    duration runs from its creation to the end of its last phase.
+    """
+
+    def __init__(self, subject, archive_report=None):
+        self.subject = subject
+        self.archive_report = archive_report
+        self.artifacts = []
+        self.phases = []
+        self.running = []
+        self.start_time = time.time()
+        self.started = MONOTONIC()
+        self.ended = self.started
+
+    @contextlib.contextmanager
+    def phase(self, phase_name, target=None):
+        """Time a phase of this build"""
+        phase = {
+            'phase': phase_name,
+            'duration': 0.0,
+            'bytes_read': 0,
+            'bytes_written': 0,
+            'appliance_launches': 0
+        }
+        if target:
+            phase['target'] = os.path.basename(target)
+        # phase, start time and time spent in nested phases
+        running = [phase, MONOTONIC(), 0.0]
+        self.running.append(running)
+        try:
+            yield phase
+        finally:
+            self.running.pop()
+            self.ended = MONOTONIC()
+            elapsed = self.ended - running[1]
+            phase['duration'] = round(elapsed - running[2], 3)
+            if self.running:
+                self.running[-1][2] += elapsed
+            self.phases.append(phase)
+
+    def count(self, bytes_read=0, bytes_written=0, appliance_launches=0):
+        """Add to the counters of the innermost running phase"""
+        if not self.running:
+            return
+        phase = self.running[-1][0]
+        phase['bytes_read'] += bytes_read
+        phase['bytes_written'] += bytes_written
+        phase['appliance_launches'] += appliance_launches
+
+    def to_dict(self):
+        """The JSON report of this build so far"""
+        report = {
+            'run_id': RUN_ID,
+            'subject': os.path.basename(self.subject),
+            'started': datetime.datetime.utcfromtimestamp(
+                self.start_time).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'duration': round(self.ended - self.started, 3),
+            'phases': self.phases,
+            'totals': phase_totals(self.phases)
+        }
+        if self.artifacts:
+            report['artifacts'] = [
+                os.path.basename(a) for a in self.artifacts
+            ]
+        if self.archive_report:
+            report['archive'] = self.archive_report.to_dict()
+        return report
+
+    def artifact_report_file(self):
+        """The report file named after the last finished artifact
+
+        Images are packaged into an OVA or renamed with the build ID as
+        they are finished, so the report of an image is written next to
+        its final name rather than the name it was patched under.
+        """
+        if self.artifacts:
+            return "%s.report" % self.artifacts[-1]
+        return "%s.report" % self.subject
+
+    def write(self, report_file):
+        """Write the JSON report with one atomic replace"""
+        tmp_file_path = "%s.tmp" % report_file
+        with open(tmp_file_path, 'w') as rf:
+            json.dump(self.to_dict(), rf, indent=4, sort_keys=True)
+        os.rename(tmp_file_path, report_file)
+
+
+def phase_totals(phases):
+    """Sum the durations and counters of build phases by phase name"""
+    totals = {}
+    for phase in phases:
+        total = totals.setdefault(
+            phase['phase'], {
+                'count': 0,
+                'duration': 0.0,
+                'bytes_read': 0,
+                'bytes_written': 0,
+                'appliance_launches': 0
+            })
+        total['count'] += 1
+        total['duration'] = round(total['duration'] + phase['duration'], 3)
+        for counter in ['bytes_read', 'bytes_written', 'appliance_launches']:
+            total[counter] += phase[counter]
+    return totals
+
+
+@contextlib.contextmanager
+def active_report(report):
+    """Record build phases into a report for the duration of a block"""
+    global ACTIVE_REPORT
+    previous = ACTIVE_REPORT
+    ACTIVE_REPORT = report
+    try:
+        yield report
+    finally:
+        ACTIVE_REPORT = previous
+
+
+@contextlib.contextmanager
+def report_phase(phase_name, target=None):
+    """Time a phase into the active build report, if there is one"""
+    if not ACTIVE_REPORT:
+        yield None
+        return
+    with ACTIVE_REPORT.phase(phase_name, target) as phase:
+        yield phase
+
+
+def report_count(bytes_read=0, bytes_written=0, appliance_launches=0):
+    """Count bytes or appliance launches in the active build report"""
+    if ACTIVE_REPORT:
+        ACTIVE_REPORT.count(bytes_read, bytes_written, appliance_launches)
+
+
+def allocated_bytes(file_path):
+    """Bytes allocated on disk to a file, 0 if it does not exist"""
+    if not os.path.exists(file_path):
+        return 0
+    return os.stat(file_path).st_blocks * 512
+
+
+def write_build_summary(tmos_image_dir, run_report, report_file=None,
+                        failed=None):
+    """Write the run report with every image report from this run
+
+    Image reports are read back from their image directories, since
+    parallel workers write them in their own processes. Phases of an
+    archive shared by several images are counted once in the totals.
+    Workers which failed to patch their archive are listed as failed.
+    """
+    if not report_file:
+        report_file = os.path.join(tmos_image_dir, BUILD_REPORT_FILE)
+    images = []
+    archive_phases = {}
+    phases = list(run_report.phases)
+    for image_report_file in sorted(
+            glob.glob("%s/*/*.report" % tmos_image_dir)):
+        try:
+            with open(image_report_file, 'r') as rf:
+                image_report = json.load(rf)
+        except (IOError, ValueError) as ex:
+            LOG.warn('could not read build report %s: %s', image_report_file,
+                     ex)
+            continue
+        if image_report.get('run_id') != RUN_ID:
+            continue
+        images.append(image_report)
+        phases.extend(image_report['phases'])
+        if 'archive' in image_report:
+            archive_phases[image_report['archive']
+                           ['subject']] = image_report['archive']['phases']
+    for shared_phases in archive_phases.values():
+        phases.extend(shared_phases)
+    summary = run_report.to_dict()
+    summary['images'] = images
+    summary['totals'] = phase_totals(phases)
+    summary['failed'] = sorted(failed or [])
+    tmp_file_path = "%s.tmp" % report_file
+    with open(tmp_file_path, 'w') as rf:
+        json.dump(summary, rf, indent=4, sort_keys=True)
+    os.rename(tmp_file_path, report_file)
+    LOG.info('build report for %d patched images written to %s',
+             len(images), report_file)
+
+
+def verify_images(tmos_image_dir, verify_workers=1, report_file=None):
+    """Verify patched disk images against their manifests in parallel
+
+    Writes a JSON report of every image checked and returns it. The
+    report passes only when no image failed verification.
+    """
+    global FIXED_APPLIANCE
+    if not tmos_image_dir or not os.path.exists(tmos_image_dir):
+        LOG.error("TMOS image directory %s does not exist.", tmos_image_dir)
+        sys.exit(1)
+    disk_images = scan_for_manifests(tmos_image_dir)
+    if APPLIANCE_POOL_MODE != 'none' and FIXED_APPLIANCE_DIR and disk_images:
+        FIXED_APPLIANCE = prepare_fixed_appliance(FIXED_APPLIANCE_DIR)
+    LOG.info('verifying %d patched disk images with up to %d workers',
+             len(disk_images), verify_workers)
+    if verify_workers > 1 and len(disk_images) > 1:
+        worker_count = min(verify_workers, len(disk_images))
+        pool = multiprocessing.Pool(worker_count)
+        try:
+            batches = pool.map(
+                verify_image_batch,
+                [disk_images[i::worker_count] for i in range(worker_count)])
+        finally:
+            pool.close()
+            pool.join()
+        verified = dict([(result['image'], result) for batch in batches
+                         for result in batch])
+        results = [verified[disk_image] for disk_image in disk_images]
+    else:
+        results = verify_image_batch(disk_images)
+    report = {
+        'passed': not [r for r in results if r['status'] == 'failed'],
+        'images': results
+    }
+    if not report_file:
+        report_file = os.path.join(tmos_image_dir, VERIFY_REPORT_FILE)
+    LOG.info('writing verification report %s', report_file)
+    with open(report_file, 'w+') as report_out:
+        json.dump(report, report_out, indent=4, sort_keys=True)
+    for result in results:
+        if result['status'] == 'failed':
+            LOG.error('%s failed verification: %s', result['image'],
+                      result.get('error') or "%d mismatched files" %
+                      len(result['mismatches']))
+    return report
+
+
+def scan_for_manifests(tmos_image_dir):
+    """Find patched disk images which have a manifest next to them"""
+    disk_images = []
+    for manifest_file in sorted(
+            glob.glob("%s/*/*.manifest" % tmos_image_dir)):
+        disk_images.append(manifest_file[:-len('.manifest')])
+    return disk_images
+
+
+def verify_image_batch(disk_images):
+    """Verify disk images with the appliances of one process
+
+    The appliance pool is closed once the images are verified, so
+    parallel verify workers do not leave their appliances running.
+    """
+    try:
+        return [verify_image(disk_image) for disk_image in disk_images]
+    finally:
+        close_appliance_pool()
+
+
+def verify_image(disk_image):
+    """Check every file in a disk image manifest with one read-only launch"""
+    result = {
+        'image': disk_image,
+        'status': 'passed',
+        'checked': 0,
+        'mismatches': []
+    }
+    image_ext = os.path.splitext(disk_image)[1]
+    if image_ext not in QEMU_IMG_FORMATS or not os.path.exists(disk_image):
+        # VMDK images are shipped inside an OVA and are not opened here
+        result['status'] = 'skipped'
+        result['error'] = 'no patched disk image to open'
+        return result
+    try:
+        with open("%s.manifest" % disk_image, 'r') as manifest_file:
+            entries = json.load(manifest_file)['files']
+    except (IOError, ValueError, KeyError, TypeError) as ex:
+        result['status'] = 'failed'
+        result['error'] = "unreadable manifest: %s" % ex
+        return result
+    LOG.info('verifying %d manifest files in %s', len(entries), disk_image)
+    try:
+        with TMOSImageSession(disk_image,
+                              drive_format=QEMU_IMG_FORMATS[image_ext],
+                              manifest=False,
+                              readonly=True) as session:
+            if not session.is_tmos:
+                raise Exception('not a TMOS disk image')
+            session.mount()
+            found = session.inspect_files([e['path'] for e in entries])
+    except Exception as ex:
+        result['status'] = 'failed'
+        result['error'] = str(ex)
+        return result
+    for entry in entries:
+        actual = found.get(entry['path'])
+        result['checked'] += 1
+        if not actual:
+            result['mismatches'].append({
+                'path': entry['path'],
+                'field': 'exists',
+                'expected': True,
+                'actual': False
+            })
+            continue
+        for field in ['size', 'mode', 'sha256']:
+            if actual[field] != entry[field]:
+                result['mismatches'].append({
+                    'path': entry['path'],
+                    'field': field,
+                    'expected': entry[field],
+                    'actual': actual[field]
+                })
+    if result['mismatches']:
+        result['status'] = 'failed'
+    return result
+
+
+def is_image_archive(filepath):
+    """Check a file in the image directory is an archive to patch
+
+    Build and verify reports are written next to the archives, so only
+    files with a known archive extension are patched.
+    """
+    return os.path.isfile(filepath) and os.path.splitext(
+        filepath)[1] in ARCHIVE_EXTS
+
+
+def scan_for_archives(tmos_image_dir, image_overwrite, image_build_id,
+                      input_fingerprints=None):
+    """Scan for TMOS image archives which need patching
+
+    When input fingerprints are supplied, an archive is only returned if
+    the fingerprint recorded with its previous patch artifacts differs
+    from the fingerprint of the archive and the current patch inputs.
+    Without them any previous .md5 artifact means the archive is skipped.
+    Archives with unfinished patch states are always returned, so patching
+    resumes where a stopped run left off.
+    """
+    return_archives = []
     for image_file in os.listdir(tmos_image_dir):
         filepath = "%s/%s" % (tmos_image_dir, image_file)
-        if os.path.isfile(filepath):
-            extract_dir = "%s/%s" % (tmos_image_dir,
-                                     os.path.splitext(image_file)[0])
-            if image_build_id:
-                build_split = os.path.splitext(os.path.splitext(image_file)[0])
-                if not build_split[0].endswith(image_build_id):
-                    extract_dir = "%s/%s-%s%s" % (tmos_image_dir,
-                                                  build_split[0],
-                                                  image_build_id,
-                                                  build_split[1])
+        if is_image_archive(filepath):
+            extract_dir = archive_extract_dir(tmos_image_dir, image_file,
+                                              image_build_id)
+            fingerprint = None
             if os.path.exists(extract_dir):
-                found_sum_files = False
                 LOG.debug('examining existing patching directory %s' %
                           extract_dir)
-                for existing_file in os.listdir(extract_dir):
-                    if os.path.splitext(existing_file)[1] == '.md5':
-                        LOG.debug('found previous patching artifact file %s' %
-                                  existing_file)
-                        found_sum_files = True
-                if not image_overwrite and found_sum_files:
+                previous = read_fingerprint(extract_dir)
+                if input_fingerprints is not None:
+                    fingerprint = fingerprint_archive(filepath,
+                                                      input_fingerprints,
+                                                      previous)
+                    unchanged = previous and previous[
+                        'fingerprint'] == fingerprint['fingerprint']
+                else:
+                    unchanged = False
+                    for existing_file in os.listdir(extract_dir):
+                        if os.path.splitext(existing_file)[1] == '.md5':
+                            LOG.debug(
+                                'found previous patching artifact file %s' %
+                                existing_file)
+                            unchanged = True
+                if image_overwrite:
+                    clear_patch_states(extract_dir)
+                elif unchanged and patch_state_files(extract_dir):
+                    LOG.info('unfinished patching found in %s.. resuming.',
+                             extract_dir)
+                    unchanged = False
+                if not image_overwrite and unchanged:
                     LOG.info(
                         'previous patch artifacts found in %s.. skipping patching.'
                         % extract_dir)
@@ -169,66 +1151,865 @@ def scan_for_images(tmos_image_dir, image_overwrite, image_build_id):
             else:
                 LOG.debug('creating patching directory %s' % extract_dir)
                 os.makedirs(extract_dir)
-            arch_ext = os.path.splitext(image_file)[1]
-            if arch_ext in ARCHIVE_EXTS:
-                if ARCHIVE_EXTS[arch_ext] == 'zipfile':
-                    extract_zip_archive(filepath, extract_dir)
-                if ARCHIVE_EXTS[arch_ext] == 'tarfile':
-                    extract_tar_archive(filepath, extract_dir)
-            for extracted_file in os.listdir(extract_dir):
-                if os.path.splitext(extracted_file)[1] in IMAGE_TYPES:
-                    image_filepath = "%s/%s" % (extract_dir, extracted_file)
-                    if os.path.splitext(extracted_file)[1] == '.vmdk':
-                        convert_vmdk(image_filepath,
-                                     VBOXMANAGE_CLI_PATCH_VARIANT)
-                    return_image_files.append(image_filepath)
+                if input_fingerprints is not None:
+                    fingerprint = fingerprint_archive(filepath,
+                                                      input_fingerprints)
+            return_archives.append((filepath, extract_dir, fingerprint))
+    return return_archives
+
+
+def archive_extract_dir(tmos_image_dir, image_file, image_build_id):
+    """The patching directory for an image archive"""
+    extract_dir = "%s/%s" % (tmos_image_dir, os.path.splitext(image_file)[0])
+    if image_build_id:
+        build_split = os.path.splitext(os.path.splitext(image_file)[0])
+        if not build_split[0].endswith(image_build_id):
+            extract_dir = "%s/%s-%s%s" % (tmos_image_dir, build_split[0],
+                                          image_build_id, build_split[1])
+    return extract_dir
+
+
+def load_build_matrix(build_matrix_file):
+    """Load and validate a build matrix of patch variants
+
+    The matrix is a YAML or JSON document with a list of variants. Each
+    variant has a name and may set a cloud_template, its own
+    usr/var/shared/config inject dirs and icontrollx_dir, a
+    platform_defaults file, an output_suffix for its output directory
+    and a list of output_formats.
+    """
+    with open(build_matrix_file, 'r') as matrix_file:
+        if build_matrix_file.endswith('.json'):
+            matrix = json.load(matrix_file)
+        else:
+            matrix = yaml.safe_load(matrix_file)
+    variants = []
+    for variant in matrix.get('variants', []):
+        unknown_keys = set(variant.keys()) - set(BUILD_MATRIX_VARIANT_KEYS)
+        if 'name' not in variant or unknown_keys:
+            LOG.error('invalid build matrix variant %s in %s', variant,
+                      build_matrix_file)
+            sys.exit(1)
+        variant.setdefault('output_suffix', variant['name'])
+        for output_format in variant.get('output_formats') or []:
+            if ".%s" % output_format not in IMAGE_TYPES:
+                LOG.error('unsupported output format %s for variant %s',
+                          output_format, variant['name'])
+                sys.exit(1)
+        variants.append(variant)
+    if not variants:
+        LOG.error('build matrix %s has no variants', build_matrix_file)
+        sys.exit(1)
+    return variants
+
+
+def load_platform_defaults(platform_defaults_file):
+    """Load and validate platform defaults to bake into an image
+
+    The YAML or JSON document may set platform, the contents of the
+    /PLATFORM file, and db, a mapping of BigDB variables to values.
+    """
+    with open(platform_defaults_file, 'r') as defaults_file:
+        if platform_defaults_file.endswith('.json'):
+            defaults = json.load(defaults_file)
+        else:
+            defaults = yaml.safe_load(defaults_file)
+    if not isinstance(defaults, dict) or set(
+            defaults.keys()) - set(PLATFORM_DEFAULTS_KEYS):
+        LOG.error('invalid platform defaults in %s', platform_defaults_file)
+        sys.exit(1)
+    db_values = collections.OrderedDict()
+    for (db_key, db_value) in sorted((defaults.get('db') or {}).items()):
+        if isinstance(db_value, bool):
+            db_value = str(db_value).lower()
+        db_values[db_key] = str(db_value)
+    defaults['db'] = db_values
+    return defaults
+
+
+def scan_for_variant_archives(tmos_image_dir, image_overwrite, image_build_id,
+                              input_fingerprints, variants):
+    """Scan for TMOS image archives with build matrix variants to patch
+
+    Every variant is fingerprinted on its own, and only the variants whose
+    fingerprint changed are returned for each archive.
+    """
+    return_archives = []
+    for image_file in os.listdir(tmos_image_dir):
+        filepath = "%s/%s" % (tmos_image_dir, image_file)
+        if not is_image_archive(filepath):
+            continue
+        extract_dir = archive_extract_dir(tmos_image_dir, image_file,
+                                          image_build_id)
+        fingerprints = {}
+        archive_sha256 = None
+        for variant in variants:
+            variant_dir = "%s-%s" % (extract_dir, variant['output_suffix'])
+            previous = None
+            if os.path.exists(variant_dir):
+                previous = read_fingerprint(variant_dir)
+            variant_inputs = dict(input_fingerprints)
+            for (input_name, input_value) in fingerprint_inputs(
+                    None, variant.get('cloud_template'), {
+                        'usr': variant.get('usr_inject_dir'),
+                        'var': variant.get('var_inject_dir'),
+                        'config': variant.get('config_inject_dir'),
+                        'shared': variant.get('shared_inject_dir'),
+                        'icontrollx': variant.get('icontrollx_dir')
+                    }, None, variant.get('platform_defaults')).items():
+                variant_inputs["variant_%s" % input_name] = input_value
+            variant_inputs['variant_output_formats'] = ','.join(
+                variant.get('output_formats') or [])
+            fingerprint = fingerprint_archive(filepath, variant_inputs,
+                                              previous, archive_sha256)
+            archive_sha256 = fingerprint['archive']['sha256']
+            if not image_overwrite and previous and previous[
+                    'fingerprint'] == fingerprint['fingerprint']:
+                LOG.info(
+                    'previous patch artifacts found in %s.. skipping patching.'
+                    % variant_dir)
+                continue
+            fingerprints[variant['name']] = fingerprint
+        if fingerprints:
+            return_archives.append((filepath, extract_dir, fingerprints))
+    return return_archives
+
+
+def file_sha256(file_path):
+    """SHA-256 hex digest of a local file"""
+    sha256_hash = hashlib.sha256()
+    with open(file_path, 'rb') as fd:
+        for (block, is_hole) in read_sparse(fd):
+            sha256_hash.update(block)
+    return sha256_hash.hexdigest()
+
+
+def local_file_sha256(file_path):
+    """SHA-256 of a local patch input, computed once per run
+
+    Digests are cached by path, size and modification time. Inputs are
+    hashed while fingerprinting, before patch workers are forked, so
+    every worker reuses the same digests.
+    """
+    file_stat = os.stat(file_path)
+    cache_key = (os.path.abspath(file_path), file_stat.st_size,
+                 file_stat.st_mtime)
+    if cache_key not in LOCAL_SHA256_CACHE:
+        LOCAL_SHA256_CACHE[cache_key] = file_sha256(file_path)
+    return LOCAL_SHA256_CACHE[cache_key]
+
+
+def tree_sha256(tree_dir):
+    """SHA-256 over the relative paths, modes and contents of a local tree"""
+    tree_hash = hashlib.sha256()
+    for root, dirs, files in os.walk(tree_dir):
+        dirs.sort()
+        for file_name in sorted(files):
+            file_path = os.path.join(root, file_name)
+            tree_hash.update(("%s %o %s\n" % (
+                file_path[len(tree_dir):], os.stat(file_path).st_mode,
+                local_file_sha256(file_path))).encode('utf-8'))
+    return tree_hash.hexdigest()
+
+
+def fingerprint_inputs(tmos_cloudinit_dir, cloud_template_file, inject_dirs,
+                       private_pem_key_path, platform_defaults_file=None):
+    """Fingerprint every patch input shared by all images in this run
+
+    Settings which change the bytes of the patched images, such as free
+    space sparsifying, qcow2 compression, the VMDK converter and the
+    python versions modules are precompiled for, are inputs too.
+    """
+    inputs = {}
+    if tmos_cloudinit_dir:
+        inputs['cloudinit_modules'] = tree_sha256(
+            "%s/image_patch_files/system_python_path" % tmos_cloudinit_dir)
+        inputs['precompiled_pyc'] = ','.join([
+            python_version for python_version in TMOS_PYTHON_VERSIONS
+            if find_executable(python_version)
+        ])
+    if cloud_template_file:
+        inputs['cloud_template'] = local_file_sha256(cloud_template_file)
+    for inject_name in sorted(inject_dirs):
+        if inject_dirs[inject_name] and os.path.isdir(
+                inject_dirs[inject_name]):
+            inputs["%s_inject" % inject_name] = tree_sha256(
+                inject_dirs[inject_name])
+    if platform_defaults_file:
+        inputs['platform_defaults'] = local_file_sha256(platform_defaults_file)
+    if ICONTROLLX_PREINSTALL:
+        inputs['icontrollx_preinstall'] = True
+    if OUTPUT_FORMATS:
+        inputs['output_formats'] = ','.join(OUTPUT_FORMATS)
+    inputs['image_sparsify'] = IMAGE_SPARSIFY
+    inputs['qcow2_compress'] = QCOW2_COMPRESS
+    inputs['vmdk_converter'] = vmdk_converter()
+    if BLOCK_DELTA:
+        inputs['block_delta'] = BLOCK_DELTA_VERSION
+    if private_pem_key_path:
+        with open(private_pem_key_path, 'r') as key_file:
+            public_key = RSA.importKey(key_file.read()).publickey()
+        inputs['signing_key'] = hashlib.sha256(
+            public_key.exportKey('DER')).hexdigest()
+    return inputs
+
+
+def fingerprint_archive(archive_file, input_fingerprints, previous=None,
+                        archive_sha256=None):
+    """Fingerprint one source archive together with the patch inputs
+
+    The archive digest recorded in a previous fingerprint is reused when
+    the archive size and modification time have not changed, so
+    unchanged multi-GB archives are not reread on every run.
+    """
+    archive = archive_identity(archive_file)
+    if archive_sha256:
+        archive['sha256'] = archive_sha256
+    elif previous and previous.get('archive', {}).get('name') == archive[
+            'name'] and previous['archive'].get('size') == archive[
+                'size'] and previous['archive'].get('mtime') == archive[
+                    'mtime']:
+        archive['sha256'] = previous['archive']['sha256']
+    else:
+        LOG.info('fingerprinting source archive %s', archive_file)
+        archive['sha256'] = file_sha256(archive_file)
+    components = {'archive': archive['sha256']}
+    components.update(input_fingerprints)
+    return {
+        'fingerprint':
+        hashlib.sha256(
+            json.dumps(components, sort_keys=True).encode('utf-8')).hexdigest(),
+        'archive': archive,
+        'inputs': input_fingerprints
+    }
+
+
+def read_fingerprint(extract_dir):
+    """Read the fingerprint recorded with previous patch artifacts"""
+    for existing_file in os.listdir(extract_dir):
+        if existing_file.endswith('.fingerprint'):
+            try:
+                with open(os.path.join(extract_dir, existing_file),
+                          'r') as fp_file:
+                    return json.load(fp_file)
+            except Exception as ex:
+                LOG.warn('ignoring unreadable fingerprint %s: %s',
+                         existing_file, ex)
+    return None
+
+
+def write_fingerprint(disk_image, fingerprint):
+    """Record the patch input fingerprint next to a patched artifact"""
+    fingerprint_file_path = "%s.fingerprint" % disk_image
+    LOG.info('recording patch fingerprint for %s as %s', disk_image,
+             fingerprint_file_path)
+    with open(fingerprint_file_path, 'w+') as fp_file:
+        json.dump(fingerprint, fp_file, indent=4, sort_keys=True)
+
+
+def archive_identity(archive_file):
+    """Name, size and modification time of a source archive"""
+    archive_stat = os.stat(archive_file)
+    return {
+        'name': os.path.basename(archive_file),
+        'size': archive_stat.st_size,
+        'mtime': int(archive_stat.st_mtime)
+    }
+
+
+class PatchState(object):
+    """Patch phases completed for one disk image, kept in a state file
+
+    Each phase is recorded with the inputs it was completed with, the
+    source archive for extraction and VMDK conversion and the patch input
+    fingerprint for every later phase. A phase is only recorded once its
+    results are on disk, so a run stopped part way through, for example by
+    an out of memory kill, resumes after the last completed phase. The
+    state file is removed once the image is finished.
+    """
+
+    def __init__(self, disk_image, inputs=None):
+        self.disk_image = disk_image
+        self.inputs = inputs
+        self.state_file = "%s%s" % (disk_image, PATCH_STATE_SUFFIX)
+        self.phases = {}
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file, 'r') as state_in:
+                    state = json.load(state_in)
+                if state.get('version') == PATCH_STATE_VERSION:
+                    self.phases = state['phases']
+            except (IOError, ValueError, KeyError) as ex:
+                LOG.warn('ignoring unreadable patch state %s: %s',
+                         self.state_file, ex)
+
+    def done(self, phase_name, inputs=None):
+        """Was the phase completed with the same inputs"""
+        if inputs is None:
+            inputs = self.inputs
+        return phase_name in self.phases and self.phases[phase_name] == inputs
+
+    def record(self, phase_name, inputs=None):
+        """Record a completed phase, replacing the state file atomically"""
+        if inputs is None:
+            inputs = self.inputs
+        self.phases[phase_name] = inputs
+        state_tmp = "%s.tmp" % self.state_file
+        with open(state_tmp, 'w') as state_out:
+            json.dump(
+                {
+                    'version': PATCH_STATE_VERSION,
+                    'image': os.path.basename(self.disk_image),
+                    'phases': self.phases
+                },
+                state_out,
+                indent=4,
+                sort_keys=True)
+        os.rename(state_tmp, self.state_file)
+
+    def remove(self):
+        """Forget the completed phases of a finished image"""
+        self.phases = {}
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
+
+def patch_state_files(extract_dir):
+    """Patch state files of the unfinished images in a directory"""
+    return sorted(glob.glob("%s/*%s" % (extract_dir, PATCH_STATE_SUFFIX)))
+
+
+def clear_patch_states(extract_dir):
+    """Forget the completed phases of every image in a directory"""
+    for state_file in patch_state_files(extract_dir):
+        os.remove(state_file)
+
+
+def resumable_images(extract_dir, inputs, archive=None):
+    """Unfinished disk images a stopped run left in a directory
+
+    Nothing is returned unless the state of every image there was
+    recorded while patching with the same inputs, or before patching
+    began. With an archive, every image must also have been extracted
+    from it and still be in place, unless it was already packaged or
+    renamed.
+    """
+    disk_images = []
+    for state_file in patch_state_files(extract_dir):
+        state = PatchState(state_file[:-len(PATCH_STATE_SUFFIX)], inputs)
+        if 'patching' in state.phases and not state.done('patching'):
+            return []
+        if archive:
+            image_name = os.path.basename(state.disk_image)
+            if not state.done('extracted', archive):
+                return []
+            if not (os.path.exists(state.disk_image)
+                    or state.done("packaged:%s" % image_name)
+                    or state.done("renamed:%s" % image_name)):
+                return []
+        disk_images.append(state.disk_image)
+    return disk_images
+
+
+def extract_image_archive(filepath, extract_dir, inputs=None):
+    """Extract an image archive and return its patchable disk images
+
+    Extraction and VMDK conversion are recorded in the patch state of each
+    image. Images a stopped run already extracted from the same archive,
+    and did not patch with other inputs, are reused without extracting
+    the archive again.
+    """
+    return_image_files = []
+    arch_ext = os.path.splitext(filepath)[1]
+    archive = archive_identity(filepath)
+    resumed = resumable_images(extract_dir, inputs, archive)
+    if resumed:
+        LOG.info('resuming with images already extracted into %s',
+                 extract_dir)
+        return_image_files = resumed
+    elif arch_ext in ARCHIVE_EXTS:
+        clear_patch_states(extract_dir)
+        with report_phase('extract', filepath):
+            if ARCHIVE_EXTS[arch_ext] == 'zipfile':
+                extract_zip_archive(filepath, extract_dir)
+            if ARCHIVE_EXTS[arch_ext] == 'tarfile':
+                extract_tar_archive(filepath, extract_dir)
+            report_count(
+                bytes_read=os.path.getsize(filepath),
+                bytes_written=sum([
+                    allocated_bytes(os.path.join(extract_dir, f))
+                    for f in os.listdir(extract_dir)
+                ]))
+    if not resumed:
+        for extracted_file in os.listdir(extract_dir):
+            if os.path.splitext(extracted_file)[1] in IMAGE_TYPES:
+                image_filepath = "%s/%s" % (extract_dir, extracted_file)
+                if arch_ext in ARCHIVE_EXTS:
+                    PatchState(image_filepath).record('extracted', archive)
+                return_image_files.append(image_filepath)
+    for image_filepath in return_image_files:
+        if os.path.splitext(image_filepath)[1] == '.vmdk':
+            state = PatchState(image_filepath)
+            if not state.done('converted', archive):
+                convert_vmdk(image_filepath, VBOXMANAGE_CLI_PATCH_VARIANT)
+                state.record('converted', archive)
+    return return_image_files
+
+
+def scan_for_images(tmos_image_dir, image_overwrite, image_build_id):
+    """Scan for TMOS disk images"""
+    return_image_files = []
+    with report_phase('scan', tmos_image_dir):
+        archives = scan_for_archives(tmos_image_dir, image_overwrite,
+                                     image_build_id)
+    for (filepath, extract_dir, fingerprint) in archives:
+        return_image_files.extend(extract_image_archive(filepath, extract_dir))
     return return_image_files
 
 
+def extract_pristine_images(archive_file, pristine_root):
+    """Extract an archive once into the read-only pristine image store
+
+    The pristine images are reused for as long as the archive name, size
+    and modification time are unchanged, so patching another variant of
+    the same release never extracts or converts the archive again.
+    """
+    pristine_dir = os.path.join(
+        pristine_root,
+        os.path.splitext(os.path.basename(archive_file))[0])
+    marker_path = os.path.join(pristine_dir, PRISTINE_MARKER)
+    archive = archive_identity(archive_file)
+    if os.path.exists(marker_path):
+        with open(marker_path, 'r') as marker_file:
+            marker = json.load(marker_file)
+        if marker['archive'] == archive:
+            LOG.info('reusing pristine images from %s', pristine_dir)
+            return [
+                os.path.join(pristine_dir, image_name)
+                for image_name in marker['images']
+            ]
+        os.remove(marker_path)
+    if not os.path.exists(pristine_dir):
+        os.makedirs(pristine_dir)
+    LOG.info('extracting pristine images for %s into %s', archive_file,
+             pristine_dir)
+    pristine_images = extract_image_archive(archive_file, pristine_dir)
+    for pristine_image in pristine_images:
+        os.chmod(pristine_image, 0o444)
+    with open(marker_path, 'w+') as marker_file:
+        json.dump(
+            {
+                'archive': archive,
+                'images': [os.path.basename(i) for i in pristine_images]
+            }, marker_file)
+    return pristine_images
+
+
+def copy_pristine_descriptors(pristine_dir, extract_dir):
+    """Copy OVF descriptors needed to rebuild an OVA from pristine images"""
+    for file_name in os.listdir(pristine_dir):
+        if file_name.endswith('.ovf'):
+            dest_path = os.path.join(extract_dir, file_name)
+            shutil.copyfile(os.path.join(pristine_dir, file_name), dest_path)
+
+
+def create_overlay(base_image, overlay_image, base_format=None):
+    """Create a thin qcow2 overlay backed by a read-only base image"""
+    if not base_format:
+        base_format = QEMU_IMG_FORMATS[os.path.splitext(base_image)[1]]
+    LOG.info('creating qcow2 overlay %s backed by %s', overlay_image,
+             base_image)
+    if os.path.exists(overlay_image):
+        os.remove(overlay_image)
+    subprocess.check_call([
+        QEMU_IMG_CLI, 'create', '-f', 'qcow2', '-o',
+        "backing_file=%s,backing_fmt=%s" %
+        (os.path.abspath(base_image), base_format), overlay_image
+    ])
+
+
+def flatten_overlay(overlay_image, output_image, output_format=None):
+    """Flatten an overlay and its backing image into a standalone image"""
+    if not output_format:
+        output_format = QEMU_IMG_FORMATS[os.path.splitext(output_image)[1]]
+    LOG.info('flattening overlay %s into %s image %s', overlay_image,
+             output_format, output_image)
+    with report_phase('flatten', output_image):
+        qemu_img_convert(overlay_image, output_image, output_format,
+                         source_format='qcow2',
+                         compress=QCOW2_COMPRESS and output_format == 'qcow2')
+
+
+def compact_image(disk_image):
+    """Rewrite a patched qcow2 image without its zeroed or trimmed blocks
+
+    Other formats are left as they are. VMDK images are rewritten as
+    stream optimized when they are packaged, and VHD images keep their
+    original subformat.
+    """
+    if os.path.splitext(disk_image)[1] != '.qcow2':
+        return
+    LOG.info('compacting patched image %s', disk_image)
+    compacting_image = "%s.compacting" % disk_image
+    with report_phase('compact', disk_image):
+        qemu_img_convert(disk_image, compacting_image, 'qcow2',
+                         source_format='qcow2', compress=QCOW2_COMPRESS)
+        move_file(compacting_image, disk_image)
+
+
+def convert_output_image(disk_image, output_image):
+    """Convert a patched image into another output format"""
+    source_format = QEMU_IMG_FORMATS[os.path.splitext(disk_image)[1]]
+    output_format = QEMU_IMG_FORMATS[os.path.splitext(output_image)[1]]
+    LOG.info('converting patched image %s to %s image %s', disk_image,
+             output_format, output_image)
+    with report_phase('convert', output_image):
+        qemu_img_convert(disk_image, output_image, output_format,
+                         source_format=source_format,
+                         compress=QCOW2_COMPRESS and output_format == 'qcow2')
+
+
+def write_block_delta(overlays, pristine_image, delta_file):
+    """Write the guest blocks an overlay chain changed as a block delta
+
+    Overlays are listed top first, with the pristine image backing the
+    last one. Every extent allocated in an overlay is a changed extent.
+    Their data is read from a sparse raw export of the overlay chain with
+    the pristine image detached. The delta is a tar archive of delta.json,
+    listing each changed extent with its SHA-256 and the merkle root over
+    them, and extents.bin, holding the data of the non-zero extents in
+    order.
+    """
+    LOG.info('writing block delta %s against %s', delta_file, pristine_image)
+    block_map = json.loads(
+        subprocess.check_output([
+            QEMU_IMG_CLI, 'map', '--output=json', '-f', 'qcow2',
+            os.path.abspath(overlays[0])
+        ]).decode('utf-8'))
+    virtual_size = 0
+    changed_extents = []
+    for extent in block_map:
+        virtual_size = max(virtual_size, extent['start'] + extent['length'])
+        if extent['depth'] < len(overlays):
+            changed_extents.append(extent)
+    chain = None
+    for overlay in reversed(overlays):
+        chain = {
+            'driver': 'qcow2',
+            'file': {
+                'driver': 'file',
+                'filename': os.path.abspath(overlay)
+            },
+            'backing': chain
+        }
+    changes_file = "%s.changes" % delta_file
+    extents_file = "%s.extents" % delta_file
+    try:
+        subprocess.check_call([
+            QEMU_IMG_CLI, 'convert', '-O', 'raw',
+            "json:%s" % json.dumps(chain),
+            os.path.abspath(changes_file)
+        ])
+        extents = []
+        with open(changes_file, 'rb') as changes:
+            with open(extents_file, 'wb') as extents_data:
+                for extent in changed_extents:
+                    is_zero = extent['zero'] or not extent['data']
+                    extent_hash = block_delta_extent_hash(
+                        extent['start'], extent['length'], is_zero)
+                    if not is_zero:
+                        changes.seek(extent['start'])
+                        remaining = extent['length']
+                        while remaining > 0:
+                            block = changes.read(
+                                min(remaining, HASH_BLOCK_SIZE))
+                            if not block:
+                                raise IOError(
+                                    "short read of changed extent at %d in %s"
+                                    % (extent['start'], changes_file))
+                            extent_hash.update(block)
+                            extents_data.write(block)
+                            remaining -= len(block)
+                    extents.append({
+                        'offset': extent['start'],
+                        'length': extent['length'],
+                        'zero': is_zero,
+                        'sha256': extent_hash.hexdigest()
+                    })
+        delta = {
+            'format': BLOCK_DELTA_FORMAT,
+            'version': BLOCK_DELTA_VERSION,
+            'source': {
+                'image': os.path.basename(pristine_image),
+                'sha256': local_file_sha256(pristine_image)
+            },
+            'virtual_size': virtual_size,
+            'extents': extents,
+            'merkle_root': merkle_root([e['sha256'] for e in extents])
+        }
+        delta_json = json.dumps(delta, indent=2,
+                                sort_keys=True).encode('utf-8')
+        tmp_delta_file = "%s.tmp" % delta_file
+        with tarfile.open(tmp_delta_file, 'w') as delta_tar:
+            delta_info = tarfile.TarInfo('delta.json')
+            delta_info.size = len(delta_json)
+            delta_info.mtime = int(time.time())
+            delta_tar.addfile(delta_info, io.BytesIO(delta_json))
+            delta_tar.add(extents_file, arcname='extents.bin')
+        os.rename(tmp_delta_file, delta_file)
+        LOG.info('block delta %s holds %d changed extents of %d bytes',
+                 delta_file, len(extents), os.path.getsize(extents_file))
+        report_count(bytes_read=allocated_bytes(changes_file),
+                     bytes_written=os.path.getsize(delta_file))
+    finally:
+        for work_file in [changes_file, extents_file]:
+            if os.path.exists(work_file):
+                os.remove(work_file)
+
+
+def block_delta_extent_hash(offset, length, is_zero):
+    """Start the SHA-256 of a block delta extent from its position"""
+    extent_kind = 'data'
+    if is_zero:
+        extent_kind = 'zero'
+    return hashlib.sha256(
+        ("%d:%d:%s:" % (offset, length, extent_kind)).encode('ascii'))
+
+
+def merkle_root(digests):
+    """Root of a SHA-256 hash tree over hex digests paired in order"""
+    if not digests:
+        return hashlib.sha256(b'').hexdigest()
+    level = list(digests)
+    while len(level) > 1:
+        parents = []
+        for index in range(0, len(level) - 1, 2):
+            pair = level[index] + level[index + 1]
+            parents.append(hashlib.sha256(pair.encode('ascii')).hexdigest())
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+
 def extract_tar_archive(archive_file, extract_dir):
-    """Extract a tar archive"""
+    """Extract the disk image and OVF members of a tar archive"""
     LOG.debug('extracting %s to %s', archive_file, extract_dir)
-    for f in glob.glob("%s/*" % extract_dir):
-        if os.path.isfile(f):
-            os.remove(f)
-    archive = tarfile.TarFile(archive_file, 'r')
-    archive.extractall(extract_dir)
+    remove_extracted_files(extract_dir)
+    archive = tarfile.open(archive_file, 'r|')
+    for member in archive:
+        if member.isfile() and is_extract_member(member.name):
+            extract_member(archive.extractfile(member), member.name,
+                           extract_dir)
+        else:
+            LOG.debug('skipping archive member %s', member.name)
     archive.close()
 
 
 def extract_zip_archive(archive_file, extract_dir):
-    """Extract a zip archive"""
+    """Extract the disk image and OVF members of a zip archive"""
     LOG.debug('extracting %s to %s', archive_file, extract_dir)
+    remove_extracted_files(extract_dir)
+    archive = zipfile.ZipFile(archive_file, 'r')
+    for member in archive.infolist():
+        if is_extract_member(member.filename):
+            member_stream = archive.open(member)
+            extract_member(member_stream, member.filename, extract_dir)
+            member_stream.close()
+        else:
+            LOG.debug('skipping archive member %s', member.filename)
+    archive.close()
+
+
+def remove_extracted_files(extract_dir):
+    """Remove files from a previous extraction"""
     for f in glob.glob("%s/*" % extract_dir):
         if os.path.isfile(f):
             os.remove(f)
-    archive = zipfile.ZipFile(archive_file, 'r')
-    archive.extractall(extract_dir)
-    archive.close()
+
+
+def is_extract_member(member_name):
+    """Only disk images and OVF descriptors are used by the patcher"""
+    member_ext = os.path.splitext(member_name)[1]
+    return member_ext in IMAGE_TYPES or member_ext == '.ovf'
+
+
+def extract_member(member_stream, member_name, extract_dir):
+    """Stream one archive member to a sparse file in the extract directory"""
+    dest_path = os.path.join(extract_dir, os.path.basename(member_name))
+    LOG.debug('extracting archive member %s to %s', member_name, dest_path)
+    write_sparse(member_stream, dest_path)
+
+
+def write_sparse(source_stream, dest_path):
+    """Copy a stream to a file, seeking over zero blocks to leave holes"""
+    size = 0
+    with open(dest_path, 'wb') as dest:
+        for block in iter(lambda: source_stream.read(SPARSE_BLOCK_SIZE),
+                          b''):
+            if block.count(b'\0') == len(block):
+                dest.seek(len(block), os.SEEK_CUR)
+            else:
+                dest.write(block)
+            size += len(block)
+        dest.truncate(size)
+    return size
+
+
+def file_extents(fd):
+    """Yield (offset, length, is_data) extents of an open file
+
+    Holes are found with SEEK_DATA and SEEK_HOLE. Filesystems which do
+    not support them report the rest of the file as one data extent.
+    """
+    size = os.fstat(fd.fileno()).st_size
+    offset = 0
+    while offset < size:
+        try:
+            data_offset = os.lseek(fd.fileno(), offset, SEEK_DATA)
+        except OSError as ex:
+            if ex.errno != errno.ENXIO:
+                yield (offset, size - offset, True)
+                return
+            # no data past offset, only a trailing hole remains
+            data_offset = size
+        if data_offset > offset:
+            yield (offset, data_offset - offset, False)
+        if data_offset >= size:
+            return
+        hole_offset = min(os.lseek(fd.fileno(), data_offset, SEEK_HOLE),
+                          size)
+        yield (data_offset, hole_offset - data_offset, True)
+        offset = hole_offset
+
+
+def read_sparse(fd):
+    """Yield (block, is_hole) for the whole file without reading holes
+
+    Hole blocks are slices of a precomputed zero block, so digests over
+    the file match a full read while only allocated extents cost I/O.
+    """
+    for (offset, length, is_data) in file_extents(fd):
+        if is_data:
+            fd.seek(offset)
+            while length > 0:
+                block = fd.read(min(length, HASH_BLOCK_SIZE))
+                if not block:
+                    break
+                length -= len(block)
+                yield (block, False)
+        else:
+            while length > 0:
+                if length >= HASH_BLOCK_SIZE:
+                    block = ZERO_BLOCK
+                else:
+                    block = ZERO_BLOCK[:length]
+                length -= len(block)
+                yield (block, True)
+
+
+def copy_sparse(source_path, dest_path):
+    """Copy a file keeping its holes, returning the allocated bytes copied"""
+    copied = 0
+    with open(source_path, 'rb') as source:
+        size = os.fstat(source.fileno()).st_size
+        with open(dest_path, 'wb') as dest:
+            for (offset, length, is_data) in file_extents(source):
+                if not is_data:
+                    continue
+                source.seek(offset)
+                dest.seek(offset)
+                while length > 0:
+                    block = source.read(min(length, HASH_BLOCK_SIZE))
+                    if not block:
+                        break
+                    dest.write(block)
+                    length -= len(block)
+                    copied += len(block)
+            dest.truncate(size)
+    shutil.copystat(source_path, dest_path)
+    return copied
+
+
+def move_file(source_path, dest_path):
+    """Rename a file, falling back to a sparse copy across filesystems"""
+    try:
+        os.rename(source_path, dest_path)
+    except OSError as ex:
+        if ex.errno != errno.EXDEV:
+            raise
+        LOG.debug('sparse copying %s to %s across filesystems', source_path,
+                  dest_path)
+        copy_sparse(source_path, dest_path)
+        os.remove(source_path)
 
 
 def convert_vmdk(image_file, variant):
     """Force convert VMDK image files to standard format"""
-    start_directory = os.getcwd()
-    convert_dir = os.path.dirname(image_file)
-    image_file = os.path.basename(image_file)
     LOG.warn('converting VMDK format to %s format', variant)
-    os.chdir(convert_dir)
-    FNULL = open(os.devnull, 'w')
-    subprocess.call([
-        VBOXMANAGE_CLI,
-        'clonemedium',
-        '--format',
-        VBOXMANAGE_CLI_FORMAT,
-        '--variant',
-        variant,
-        image_file,
-        'converted.vmdk',
-    ],
-                    stdout=FNULL,
-                    stderr=subprocess.STDOUT)
-    subprocess.call(['/bin/mv', '-f', 'converted.vmdk', image_file])
-    os.chdir(start_directory)
+    with report_phase('convert_vmdk', image_file):
+        converted_file = "%s.converting" % os.path.abspath(image_file)
+        if vmdk_converter() == 'vboxmanage':
+            FNULL = open(os.devnull, 'w')
+            subprocess.call([
+                VBOXMANAGE_CLI,
+                'clonemedium',
+                '--format',
+                VBOXMANAGE_CLI_FORMAT,
+                '--variant',
+                variant,
+                os.path.abspath(image_file),
+                converted_file,
+            ],
+                            stdout=FNULL,
+                            stderr=subprocess.STDOUT)
+            FNULL.close()
+            report_count(bytes_read=allocated_bytes(image_file),
+                         bytes_written=allocated_bytes(converted_file))
+        else:
+            qemu_img_convert(image_file, converted_file, 'vmdk',
+                             source_format='vmdk',
+                             options="subformat=%s" %
+                             QEMU_IMG_VMDK_SUBFORMATS[variant])
+        move_file(converted_file, image_file)
+
+
+def vmdk_converter():
+    """VMDK conversion backend, qemu-img when VirtualBox is missing"""
+    if VMDK_CONVERTER == 'auto':
+        if os.path.exists(VBOXMANAGE_CLI):
+            return 'vboxmanage'
+        return 'qemu-img'
+    return VMDK_CONVERTER
+
+
+def qemu_img_convert(source_image, dest_image, output_format,
+                     source_format=None, options=None, compress=False):
+    """Convert a disk image with parallel qemu-img coroutines
+
+    Zeroed and discarded blocks of the source are not allocated in the
+    destination. With compress, qcow2 clusters are written compressed.
+    """
+    convert_cmd = [
+        QEMU_IMG_CLI, 'convert', '-m',
+        str(QEMU_IMG_COROUTINES), '-O', output_format
+    ]
+    if source_format:
+        convert_cmd.extend(['-f', source_format])
+    if options:
+        convert_cmd.extend(['-o', options])
+    if compress:
+        convert_cmd.append('-c')
+    # stream optimized VMDK and compressed clusters are written in order
+    elif not options or 'streamOptimized' not in options:
+        convert_cmd.append('-W')
+    convert_cmd.extend(
+        [os.path.abspath(source_image),
+         os.path.abspath(dest_image)])
+    LOG.debug('running %s', ' '.join(convert_cmd))
+    subprocess.check_call(convert_cmd)
+    report_count(bytes_read=allocated_bytes(source_image),
+                 bytes_written=allocated_bytes(dest_image))
 
 
 def clean_up_vmdk(disk_image):
@@ -237,7 +2018,7 @@ def clean_up_vmdk(disk_image):
     convert_dir = os.path.dirname(disk_image)
     for file_name in os.listdir(convert_dir):
         if file_name.endswith('.mf'):
-            LOG.warn('removing mf hash file %s', file_name)
+            LOG.warn('removing stale mf hash file %s', file_name)
             os.remove(os.path.join(convert_dir, file_name))
     for file_name in os.listdir(convert_dir):
         if file_name.endswith('.cert'):
@@ -249,17 +2030,98 @@ def clean_up_vmdk(disk_image):
             LOG.warn('patching OVF to remove restrictions')
             ovf_file_name = file_name
             clean_ovf(os.path.join(convert_dir, file_name))
-    ova_name = "%s.ova" % os.path.basename(convert_dir)
-    LOG.info('createing OVA image %s', ova_name)
-    start_directory = os.getcwd()
-    os.chdir(convert_dir)
-    ova_file = tarfile.TarFile(ova_name, 'w')
-    ova_file.add(ovf_file_name)
-    ova_file.add(os.path.basename(disk_image))
-    ova_file.close()
-    os.remove(ovf_file_name)
-    os.remove(os.path.basename(disk_image))
-    os.chdir(start_directory)
+    if not ovf_file_name:
+        # converted from another format, there is no OVF to package with
+        return (disk_image, None)
+    ova_path = ova_image_path(disk_image)
+    ovf_path = os.path.join(convert_dir, ovf_file_name)
+    LOG.info('createing OVA image %s', ova_path)
+    with report_phase('package', ova_path):
+        with open(ova_path, 'wb') as ova_out:
+            ova_writer = OVAWriter(HashingWriter(ova_out))
+            ova_writer.add(ovf_path)
+            ova_writer.add(disk_image)
+            ova_writer.add_manifest("%s.mf" %
+                                    os.path.splitext(ovf_file_name)[0])
+            ova_writer.close()
+        report_count(bytes_read=allocated_bytes(disk_image),
+                     bytes_written=allocated_bytes(ova_path))
+    os.remove(ovf_path)
+    os.remove(disk_image)
+    return (ova_path, ova_writer.fileobj.hasher)
+
+
+def ova_image_path(disk_image):
+    """The OVA a VMDK image is packaged into, named after its directory"""
+    convert_dir = os.path.dirname(disk_image)
+    return os.path.join(convert_dir, "%s.ova" % os.path.basename(convert_dir))
+
+
+class OVAWriter(object):
+    """Stream files into a USTAR OVA, digesting each member as it passes
+
+    Member data is copied in large blocks and hashed with SHA-256 on the
+    way through, so the OVF manifest can be appended after the last
+    member without reading any file a second time. Holes in a member
+    are hashed as zeros and seeked over so the OVA stays sparse.
+    """
+
+    # USTAR headers hold the member size in 11 octal digits, so members
+    # of 8 GiB or more are written with a GNU header, which stores the
+    # size as base-256 like the tarfile module did for OVAs before.
+    USTAR_MAX_SIZE = 8**11 - 1
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digests = collections.OrderedDict()
+
+    def _write_member(self, tarinfo, blocks):
+        member_hash = hashlib.sha256()
+        if tarinfo.size > self.USTAR_MAX_SIZE:
+            LOG.debug('writing %s with a GNU tar header for its %d bytes',
+                      tarinfo.name, tarinfo.size)
+            self.fileobj.write(tarinfo.tobuf(format=tarfile.GNU_FORMAT))
+        else:
+            self.fileobj.write(tarinfo.tobuf(format=tarfile.USTAR_FORMAT))
+        for (block, is_hole) in blocks:
+            member_hash.update(block)
+            if is_hole:
+                self.fileobj.skip(block)
+            else:
+                self.fileobj.write(block)
+        remainder = tarinfo.size % tarfile.BLOCKSIZE
+        if remainder:
+            self.fileobj.write(b'\0' * (tarfile.BLOCKSIZE - remainder))
+        self.digests[tarinfo.name] = member_hash.hexdigest()
+
+    def add(self, file_path):
+        """Stream a local file into the OVA under its base name"""
+        file_stat = os.stat(file_path)
+        tarinfo = tarfile.TarInfo(os.path.basename(file_path))
+        tarinfo.size = file_stat.st_size
+        tarinfo.mtime = int(file_stat.st_mtime)
+        tarinfo.mode = 0o644
+        with open(file_path, 'rb') as source:
+            self._write_member(tarinfo, read_sparse(source))
+
+    def add_manifest(self, manifest_name):
+        """Append an OVF manifest with the digests of all members so far"""
+        manifest = ''.join([
+            "SHA256(%s)= %s\n" % (name, digest)
+            for (name, digest) in self.digests.items()
+        ]).encode('utf-8')
+        tarinfo = tarfile.TarInfo(manifest_name)
+        tarinfo.size = len(manifest)
+        tarinfo.mtime = int(time.time())
+        tarinfo.mode = 0o644
+        self._write_member(tarinfo, [(manifest, False)])
+
+    def close(self):
+        """Write the end of archive blocks padded to a full record"""
+        self.fileobj.write(b'\0' * (tarfile.BLOCKSIZE * 2))
+        remainder = self.fileobj.tell() % tarfile.RECORDSIZE
+        if remainder:
+            self.fileobj.write(b'\0' * (tarfile.RECORDSIZE - remainder))
 
 
 def clean_ovf(ovf_file_path):
@@ -283,42 +2145,131 @@ def clean_ovf(ovf_file_path):
     os.remove(os.path.join(working_dir, "%s.backup" % file_name))
 
 
-def add_to_manifest(filepath, disk_image):
+def manifest_entry(file_system, remote, local):
+    """Describe one injected file for the disk image manifest"""
+    file_stat = os.stat(local)
+    return {
+        'filesystem': file_system,
+        'path': remote,
+        'size': file_stat.st_size,
+        'mode': "%04o" % (file_stat.st_mode & 0o7777),
+        'sha256': local_file_sha256(local)
+    }
+
+
+def write_manifest(disk_image, entries):
+    """Write the JSON manifest of injected files with one atomic replace"""
     manifest_file_path = "%s.manifest" % disk_image
-    disk_name = os.path.basename(disk_image)
-    if not os.path.exists(manifest_file_path):
-        LOG.info('creating manifest file for %s as %s', disk_name,
-                 manifest_file_path)
-    with open(manifest_file_path, 'a+') as mf:
-        LOG.info('adding %s to %s', filepath, manifest_file_path)
-        mf.write("%s\n" % filepath)
+    LOG.info('writing manifest of %d injected files for %s as %s',
+             len(entries), os.path.basename(disk_image), manifest_file_path)
+    manifest = {'image': os.path.basename(disk_image), 'files': entries}
+    tmp_file_path = "%s.tmp" % manifest_file_path
+    with open(tmp_file_path, 'w') as mf:
+        json.dump(manifest, mf, indent=4, sort_keys=True)
+        mf.flush()
+        os.fsync(mf.fileno())
+    os.rename(tmp_file_path, manifest_file_path)
+
+
+class MultiHasher(object):
+    """Feed the same bytes to MD5, SHA-256 and SHA-384 digests at once
+
+    The SHA-384 digest is a PyCrypto hash object so the same pass can
+    back the RSA signature of the image.
+    """
+
+    def __init__(self):
+        self.hashes = collections.OrderedDict()
+        self.hashes['md5'] = hashlib.md5()
+        self.hashes['sha256'] = hashlib.sha256()
+        self.hashes['sha384'] = SHA384.new()
+        self.size = 0
+
+    def update(self, data):
+        """Add bytes to every digest"""
+        for digest in self.hashes.values():
+            digest.update(data)
+        self.size += len(data)
+
+    def hexdigest(self, algorithm):
+        """Hex digest for one algorithm"""
+        return self.hashes[algorithm].hexdigest()
+
+
+class HashingWriter(object):
+    """File object wrapper which hashes bytes as they are written"""
+
+    def __init__(self, fileobj, hasher=None):
+        self.fileobj = fileobj
+        self.hasher = hasher or MultiHasher()
+        self.position = 0
+
+    def write(self, data):
+        """Write bytes through to the file and the digests"""
+        self.fileobj.write(data)
+        self.hasher.update(data)
+        self.position += len(data)
+
+    def skip(self, zero_block):
+        """Digest a block of zeros and seek over it to leave a hole"""
+        self.fileobj.seek(len(zero_block), os.SEEK_CUR)
+        self.hasher.update(zero_block)
+        self.position += len(zero_block)
+
+    def tell(self):
+        """Bytes written so far"""
+        return self.position
+
+    def flush(self):
+        """Flush the underlying file object"""
+        self.fileobj.flush()
+
+
+def hash_file(file_path):
+    """Read a file once, skipping holes, and return its digests"""
+    hasher = MultiHasher()
+    hole_bytes = 0
+    with open(file_path, 'rb') as fd:
+        for (block, is_hole) in read_sparse(fd):
+            hasher.update(block)
+            if is_hole:
+                hole_bytes += len(block)
+    LOG.debug('hashed %s: %d bytes read, %d bytes of holes', file_path,
+              hasher.size - hole_bytes, hole_bytes)
+    report_count(bytes_read=hasher.size - hole_bytes)
+    return hasher
 
 
-def generate_md5sum(disk_image):
-    """Create MD5 sum file for the disk image"""
+def generate_digest_files(disk_image, hasher=None):
+    """Create MD5 and SHA-256 sum files for the disk image"""
+    if not hasher:
+        LOG.info('hashing disk image %s', disk_image)
+        with report_phase('hash', disk_image):
+            hasher = hash_file(disk_image)
     md5_file_path = "%s.md5" % disk_image
     LOG.info('creating md5sum file for %s as %s', disk_image, md5_file_path)
-    md5_hash = hashlib.md5()
-    with open(disk_image, 'rb') as di:
-        for block in iter(lambda: di.read(4096), b''):
-            md5_hash.update(block)
-        with open(md5_file_path, 'w+') as md5sum:
-            md5sum.write(md5_hash.hexdigest())
+    with open(md5_file_path, 'w+') as md5sum:
+        md5sum.write(hasher.hexdigest('md5'))
+    sha256_file_path = "%s.sha256" % disk_image
+    LOG.info('creating sha256sum file for %s as %s', disk_image,
+             sha256_file_path)
+    with open(sha256_file_path, 'w+') as sha256sum:
+        sha256sum.write(hasher.hexdigest('sha256'))
+    return hasher
 
 
-def sign_image(disk_image, private_key):
+def sign_image(disk_image, private_key, hasher=None):
     """Creating SHA384 signature digest for disk image"""
     sig_file_path = "%s.384.sig" % disk_image
     LOG.info('signing image %s with private key %s', disk_image, private_key)
-    sha384_hash = SHA384.new()
-    with open(disk_image, 'rb') as di:
-        for block in iter(lambda: di.read(4096), b''):
-            sha384_hash.update(block)
+    with report_phase('sign', disk_image):
+        if not hasher:
+            hasher = hash_file(disk_image)
         pk = False
         with open(private_key, 'r') as key_file:
             pk = RSA.importKey(key_file.read())
         signer = PKCS1_v1_5.new(pk)
-        digest = signer.sign(sha384_hash)
+        digest = signer.sign(hasher.hashes['sha384'])
         with open(sig_file_path, 'w+') as sha384sig:
             sha384sig.write(digest)
 
@@ -328,45 +2279,875 @@ def wait_for_gfs(gfs_handle):
     time.sleep(5)
 
 
+class AppliancePool(object):
+    """Long lived guestfs appliances shared by the sessions of a process
+
+    When the backend can hot-plug drives, an appliance is launched once
+    with a small scratch drive. Each session's drive is then added and
+    removed while the appliance keeps running. Otherwise every session
+    launches its own appliance from the fixed appliance prepared for the
+    run, so libguestfs does not have to check or rebuild its supermin
+    appliance. Handles are never shared with forked worker processes.
+    """
+
+    def __init__(self, mode='auto', fixed_appliance=None):
+        self.mode = mode
+        self.fixed_appliance = fixed_appliance
+        self.hotplug = None
+        if mode != 'auto':
+            self.hotplug = False
+        self.idle = []
+        self.labels = {}
+        self.attached = 0
+        self.pid = os.getpid()
+        self.inherited = []
+
+    def new_handle(self):
+        """A guestfs handle using the fixed appliance, if there is one"""
+        gfs = guestfs.GuestFS(python_return_dict=True)
+        if self.fixed_appliance:
+            gfs.set_path(self.fixed_appliance)
+        return gfs
+
+    def attach(self, drive, drive_opts):
+        """Return a launched handle with the drive added"""
+        if self.pid != os.getpid():
+            # never touch handles inherited from the parent process
+            self.inherited.extend(self.idle)
+            self.idle = []
+            self.labels = {}
+            self.pid = os.getpid()
+        if self.hotplug is not False:
+            gfs = self.idle.pop() if self.idle else self.launch_hotplug()
+            if gfs:
+                label = "tmos%d" % self.attached
+                self.attached += 1
+                try:
+                    gfs.add_drive_opts(drive, label=label, **drive_opts)
+                    gfs.vgscan()
+                    gfs.vg_activate_all(True)
+                    self.labels[id(gfs)] = label
+                    LOG.debug('hot-plugged %s into a running appliance',
+                              drive)
+                    return gfs
+                except RuntimeError as ex:
+                    LOG.warn('could not hot-plug %s, launching an '
+                             'appliance per image: %s', drive, ex)
+                    self.hotplug = False
+                    self.shutdown(gfs)
+        gfs = self.new_handle()
+        gfs.add_drive_opts(drive, **drive_opts)
+        with report_phase('launch', drive):
+            gfs.launch()
+            report_count(appliance_launches=1)
+        return gfs
+
+    def launch_hotplug(self):
+        """Launch an appliance for hot-plugging, None if not supported"""
+        gfs = self.new_handle()
+        backend = gfs.get_backend()
+        if not backend.startswith('libvirt'):
+            LOG.debug('guestfs backend %s can not hot-plug drives', backend)
+            self.hotplug = False
+            gfs.close()
+            return None
+        gfs.add_drive_scratch(HOTPLUG_SCRATCH_SIZE)
+        with report_phase('launch'):
+            gfs.launch()
+            report_count(appliance_launches=1)
+        self.hotplug = True
+        return gfs
+
+    def detach(self, gfs, mounted=False):
+        """Remove a session's drive, keeping hot-plug appliances running"""
+        label = self.labels.pop(id(gfs), None)
+        if label is None:
+            if mounted:
+                gfs.umount_all()
+            self.shutdown(gfs)
+            return
+        try:
+            gfs.umount_all()
+            gfs.vg_activate_all(False)
+            gfs.remove_drive(label)
+            gfs.vgscan()
+            self.idle.append(gfs)
+        except RuntimeError as ex:
+            LOG.warn('could not remove hot-plugged drive %s: %s', label, ex)
+            self.shutdown(gfs)
+
+    def shutdown(self, gfs):
+        """Shut down and close an appliance"""
+        try:
+            gfs.shutdown()
+        except RuntimeError as ex:
+            LOG.debug('appliance shutdown failed: %s', ex)
+        gfs.close()
+        wait_for_gfs(gfs)
+
+    def close(self):
+        """Shut down the idle appliances of this process"""
+        if self.pid != os.getpid():
+            return
+        while self.idle:
+            self.shutdown(self.idle.pop())
+
+
+def appliance_pool():
+    """The appliance pool of this run, created on first use"""
+    global APPLIANCE_POOL
+    if not APPLIANCE_POOL:
+        APPLIANCE_POOL = AppliancePool(APPLIANCE_POOL_MODE, FIXED_APPLIANCE)
+    return APPLIANCE_POOL
+
+
+def close_appliance_pool():
+    """Shut down the idle appliances of the run"""
+    if APPLIANCE_POOL:
+        APPLIANCE_POOL.close()
+
+
+def prepare_fixed_appliance(appliance_dir):
+    """Build a fixed libguestfs appliance once and return its directory
+
+    The appliance is kept between runs. Remove the directory to rebuild
+    it after libguestfs is upgraded. Returns None when it can not be
+    built, so libguestfs uses its own cached appliance.
+    """
+    if all([
+            os.path.exists(os.path.join(appliance_dir, f))
+            for f in FIXED_APPLIANCE_FILES
+    ]):
+        return appliance_dir
+    make_cli = find_executable(MAKE_FIXED_APPLIANCE_CLI)
+    if not make_cli:
+        LOG.debug('%s not found, using the libguestfs cached appliance',
+                  MAKE_FIXED_APPLIANCE_CLI)
+        return None
+    LOG.info('building fixed guestfs appliance in %s', appliance_dir)
+    building_dir = "%s.building" % appliance_dir
+    shutil.rmtree(building_dir, ignore_errors=True)
+    try:
+        subprocess.check_call([make_cli, building_dir])
+    except (OSError, subprocess.CalledProcessError) as ex:
+        LOG.warn('could not build a fixed guestfs appliance: %s', ex)
+        shutil.rmtree(building_dir, ignore_errors=True)
+        return None
+    if not os.path.isdir(appliance_dir):
+        os.makedirs(appliance_dir)
+    # move the files, the appliance directory may be a mounted volume
+    for appliance_file in os.listdir(building_dir):
+        shutil.move(os.path.join(building_dir, appliance_file),
+                    os.path.join(appliance_dir, appliance_file))
+    os.rmdir(building_dir)
+    return appliance_dir
+
+
+def probe_tmos_image(disk_image, image_format=None):
+    """TMOS file systems found by reading a disk image's LVM2 metadata
+
+    The partition table and the LVM2 metadata text are read straight from
+    raw, qcow2 and VHD images, following qcow2 cluster tables and backing
+    images and the VHD block allocation table, so no appliance is
+    launched. Returns the names of the TMOS file systems whose logical
+    volumes were found, or None when the image can not be read this way.
+    """
+    probe_start = MONOTONIC()
+    try:
+        reader = open_image_reader(disk_image, image_format)
+        if not reader:
+            return None
+        with contextlib.closing(reader):
+            volume_paths = []
+            for pv_offset in partition_offsets(reader):
+                volume_paths.extend(lvm_volume_paths(reader, pv_offset))
+    except (IOError, OSError, ValueError, struct.error, zlib.error) as ex:
+        LOG.debug('could not probe %s: %s', disk_image, ex)
+        return None
+    file_systems = [
+        fs_name for fs_name, fs_match in TMOS_FILESYSTEMS.items()
+        if [path for path in volume_paths if fs_match in path]
+    ]
+    LOG.debug('probed %s in %.3f seconds, found TMOS file systems: %s',
+              disk_image,
+              MONOTONIC() - probe_start, ', '.join(file_systems) or 'none')
+    return file_systems
+
+
+def open_image_reader(image_file, image_format=None):
+    """A guest byte reader for a disk image, None for other formats
+
+    Images are recognized by their qcow2 header or VHD footer. Anything
+    else is only read as raw when its format is known to be raw.
+    """
+    with open(image_file, 'rb') as image:
+        magic = image.read(len(QCOW2_MAGIC))
+        image.seek(0, os.SEEK_END)
+        image_size = image.tell()
+        footer = b''
+        if image_size >= PROBE_SECTOR_SIZE:
+            image.seek(image_size - PROBE_SECTOR_SIZE)
+            footer = image.read(len(VHD_COOKIE))
+    if magic == QCOW2_MAGIC:
+        return Qcow2ImageReader(image_file)
+    if footer == VHD_COOKIE:
+        return VhdImageReader(image_file)
+    if image_format == 'raw' or os.path.splitext(image_file)[1] in [
+            '.raw', '.img'
+    ]:
+        return RawImageReader(image_file)
+    return None
+
+
+def read_padded(fd, offset, length, size):
+    """Read bytes from a file, as zeros past the end of its guest data"""
+    data = b''
+    if offset < size:
+        fd.seek(offset)
+        data = fd.read(min(length, size - offset))
+    return data + b'\0' * (length - len(data))
+
+
+class RawImageReader(object):
+    """Read guest bytes from a raw image"""
+
+    def __init__(self, image_file, size=None):
+        self.fd = open(image_file, 'rb')
+        self.size = size
+        if self.size is None:
+            self.size = os.fstat(self.fd.fileno()).st_size
+
+    def read(self, offset, length):
+        """Read guest bytes"""
+        return read_padded(self.fd, offset, length, self.size)
+
+    def close(self):
+        """Close the image file"""
+        self.fd.close()
+
+
+class VhdImageReader(object):
+    """Read guest bytes from a fixed or dynamic VHD image
+
+    Dynamic image blocks are found through the block allocation table.
+    Differencing images are not supported.
+    """
+
+    def __init__(self, image_file):
+        self.fd = open(image_file, 'rb')
+        self.bat = None
+        try:
+            file_size = os.fstat(self.fd.fileno()).st_size
+            self.fd.seek(file_size - PROBE_SECTOR_SIZE)
+            footer = self.fd.read(PROBE_SECTOR_SIZE)
+            (data_offset, ) = struct.unpack('>Q', footer[16:24])
+            (self.size, ) = struct.unpack('>Q', footer[48:56])
+            (disk_type, ) = struct.unpack('>I', footer[60:64])
+            if disk_type == VHD_FIXED:
+                self.size = min(self.size, file_size - PROBE_SECTOR_SIZE)
+                return
+            if disk_type != VHD_DYNAMIC:
+                raise ValueError("unsupported VHD disk type %d" % disk_type)
+            self.fd.seek(data_offset)
+            header = self.fd.read(2 * PROBE_SECTOR_SIZE)
+            if header[:len(VHD_DYNAMIC_COOKIE)] != VHD_DYNAMIC_COOKIE:
+                raise ValueError('missing VHD dynamic disk header')
+            (table_offset, ) = struct.unpack('>Q', header[16:24])
+            (table_entries, self.block_size) = struct.unpack(
+                '>II', header[28:36])
+            self.fd.seek(table_offset)
+            self.bat = struct.unpack('>%dI' % table_entries,
+                                     self.fd.read(4 * table_entries))
+            # each block starts with a sector aligned sector bitmap
+            bitmap_bytes = self.block_size // PROBE_SECTOR_SIZE // 8
+            self.bitmap_size = (bitmap_bytes + PROBE_SECTOR_SIZE -
+                                1) // PROBE_SECTOR_SIZE * PROBE_SECTOR_SIZE
+        except Exception:
+            self.fd.close()
+            raise
+
+    def read(self, offset, length):
+        """Read guest bytes"""
+        if self.bat is None:
+            return read_padded(self.fd, offset, length, self.size)
+        data = []
+        while length > 0:
+            block_index = offset // self.block_size
+            in_block = offset % self.block_size
+            chunk = min(length, self.block_size - in_block)
+            block_sector = VHD_UNALLOCATED
+            if block_index < len(self.bat):
+                block_sector = self.bat[block_index]
+            if block_sector == VHD_UNALLOCATED:
+                data.append(b'\0' * chunk)
+            else:
+                self.fd.seek(block_sector * PROBE_SECTOR_SIZE +
+                             self.bitmap_size + in_block)
+                block_data = self.fd.read(chunk)
+                data.append(block_data + b'\0' * (chunk - len(block_data)))
+            offset += chunk
+            length -= chunk
+        return b''.join(data)
+
+    def close(self):
+        """Close the image file"""
+        self.fd.close()
+
+
+class Qcow2ImageReader(object):
+    """Read guest bytes from a qcow2 image through its cluster tables
+
+    Unallocated clusters are read from the backing image, or as zeros.
+    Compressed clusters are inflated. Encrypted images and images with
+    other incompatible features, such as external data files, are not
+    supported.
+    """
+
+    def __init__(self, image_file):
+        self.fd = open(image_file, 'rb')
+        self.backing = None
+        self.l2_tables = {}
+        try:
+            header = self.fd.read(PROBE_SECTOR_SIZE)
+            (magic, version, backing_offset, backing_size, self.cluster_bits,
+             self.size, crypt_method, l1_size,
+             l1_offset) = struct.unpack('>4sIQIIQIIQ', header[:48])
+            if magic != QCOW2_MAGIC or version not in [2, 3]:
+                raise ValueError('unsupported qcow2 version')
+            if crypt_method:
+                raise ValueError('encrypted qcow2 images are not supported')
+            if version == 3:
+                (incompatible, ) = struct.unpack('>Q', header[72:80])
+                if incompatible & ~QCOW2_DIRTY:
+                    raise ValueError("unsupported qcow2 features %x" %
+                                     incompatible)
+            self.cluster_size = 1 << self.cluster_bits
+            self.l2_bits = self.cluster_bits - 3
+            self.fd.seek(l1_offset)
+            self.l1_table = struct.unpack('>%dQ' % l1_size,
+                                          self.fd.read(8 * l1_size))
+            if backing_offset:
+                self.fd.seek(backing_offset)
+                backing_file = self.fd.read(backing_size).decode('utf-8')
+                backing_file = os.path.join(os.path.dirname(image_file),
+                                            backing_file)
+                self.backing = open_image_reader(backing_file)
+                if not self.backing:
+                    raise ValueError("unsupported backing image %s" %
+                                     backing_file)
+        except Exception:
+            self.close()
+            raise
+
+    def read(self, offset, length):
+        """Read guest bytes"""
+        data = []
+        while length > 0:
+            in_cluster = offset & (self.cluster_size - 1)
+            chunk = min(length, self.cluster_size - in_cluster)
+            data.append(
+                self.read_cluster(offset - in_cluster)[in_cluster:in_cluster +
+                                                        chunk])
+            offset += chunk
+            length -= chunk
+        return b''.join(data)
+
+    def read_cluster(self, guest_offset):
+        """Read one guest cluster"""
+        l2_entry = self.l2_entry(guest_offset)
+        if l2_entry & QCOW2_COMPRESSED:
+            return self.read_compressed(l2_entry)
+        host_offset = l2_entry & QCOW2_OFFSET_MASK
+        if l2_entry & QCOW2_ZERO_CLUSTER or guest_offset >= self.size:
+            return b'\0' * self.cluster_size
+        if host_offset:
+            return read_padded(self.fd, host_offset, self.cluster_size,
+                               host_offset + self.cluster_size)
+        if self.backing:
+            return self.backing.read(guest_offset, self.cluster_size)
+        return b'\0' * self.cluster_size
+
+    def l2_entry(self, guest_offset):
+        """The L2 table entry mapping a guest cluster"""
+        l1_index = guest_offset >> (self.cluster_bits + self.l2_bits)
+        if l1_index >= len(self.l1_table):
+            return 0
+        l2_offset = self.l1_table[l1_index] & QCOW2_OFFSET_MASK
+        if not l2_offset:
+            return 0
+        if l2_offset not in self.l2_tables:
+            self.fd.seek(l2_offset)
+            self.l2_tables[l2_offset] = struct.unpack(
+                '>%dQ' % (self.cluster_size // 8),
+                self.fd.read(self.cluster_size))
+        return self.l2_tables[l2_offset][(guest_offset >> self.cluster_bits)
+                                         & ((1 << self.l2_bits) - 1)]
+
+    def read_compressed(self, l2_entry):
+        """Inflate a compressed cluster"""
+        offset_bits = 62 - (self.cluster_bits - 8)
+        host_offset = l2_entry & ((1 << offset_bits) - 1)
+        sectors = ((l2_entry >> offset_bits) &
+                   ((1 << (self.cluster_bits - 8)) - 1)) + 1
+        self.fd.seek(host_offset)
+        compressed = self.fd.read(sectors * PROBE_SECTOR_SIZE -
+                                  (host_offset % PROBE_SECTOR_SIZE))
+        cluster = zlib.decompressobj(-zlib.MAX_WBITS).decompress(
+            compressed, self.cluster_size)
+        return cluster + b'\0' * (self.cluster_size - len(cluster))
+
+    def close(self):
+        """Close the image and its backing image"""
+        if self.backing:
+            self.backing.close()
+        self.fd.close()
+
+
+def partition_offsets(reader):
+    """Byte offsets of the partitions in an MBR or GPT partition table
+
+    The start of the disk is included for LVM physical volumes without a
+    partition table.
+    """
+    offsets = [0]
+    mbr = reader.read(0, PROBE_SECTOR_SIZE)
+    if mbr[510:512] != MBR_SIGNATURE:
+        return offsets
+    for index in range(4):
+        (part_type, start_sector, sectors) = mbr_partition(mbr, index)
+        if not part_type or not sectors:
+            continue
+        if part_type == MBR_GPT_TYPE:
+            offsets.extend(gpt_partition_offsets(reader))
+        elif part_type in MBR_EXTENDED_TYPES:
+            offsets.extend(logical_partition_offsets(reader, start_sector))
+        else:
+            offsets.append(start_sector * PROBE_SECTOR_SIZE)
+    return offsets
+
+
+def mbr_partition(boot_record, index):
+    """Type, start sector and sector count of an MBR partition entry"""
+    entry = boot_record[446 + index * 16:462 + index * 16]
+    (part_type, ) = struct.unpack('<B', entry[4:5])
+    (start_sector, sectors) = struct.unpack('<II', entry[8:16])
+    return (part_type, start_sector, sectors)
+
+
+def logical_partition_offsets(reader, extended_sector):
+    """Byte offsets of the logical partitions in an extended partition"""
+    offsets = []
+    ebr_sector = extended_sector
+    for _ in range(MBR_MAX_LOGICAL):
+        ebr = reader.read(ebr_sector * PROBE_SECTOR_SIZE, PROBE_SECTOR_SIZE)
+        if ebr[510:512] != MBR_SIGNATURE:
+            break
+        (part_type, start_sector, sectors) = mbr_partition(ebr, 0)
+        if part_type and sectors:
+            offsets.append((ebr_sector + start_sector) * PROBE_SECTOR_SIZE)
+        (next_type, next_sector, next_sectors) = mbr_partition(ebr, 1)
+        if not next_type or not next_sectors:
+            break
+        ebr_sector = extended_sector + next_sector
+    return offsets
+
+
+def gpt_partition_offsets(reader):
+    """Byte offsets of the partitions in a GPT partition table"""
+    header = reader.read(PROBE_SECTOR_SIZE, PROBE_SECTOR_SIZE)
+    if header[:len(GPT_SIGNATURE)] != GPT_SIGNATURE:
+        return []
+    (entries_lba, ) = struct.unpack('<Q', header[72:80])
+    (entries, entry_size) = struct.unpack('<II', header[80:88])
+    entries = min(entries, GPT_MAX_ENTRIES)
+    table = reader.read(entries_lba * PROBE_SECTOR_SIZE, entries * entry_size)
+    offsets = []
+    for index in range(entries):
+        entry = table[index * entry_size:(index + 1) * entry_size]
+        if entry[:16] == b'\0' * 16:
+            continue
+        (first_lba, ) = struct.unpack('<Q', entry[32:40])
+        offsets.append(first_lba * PROBE_SECTOR_SIZE)
+    return offsets
+
+
+def lvm_volume_paths(reader, pv_offset):
+    """Logical volume device paths in the LVM2 metadata of a physical volume
+
+    The label is looked for in the first sectors of the physical volume.
+    The current metadata text is read from the first metadata area which
+    holds one, wrapping around the end of its circular buffer.
+    """
+    for sector in range(LVM_LABEL_SECTORS):
+        label = reader.read(pv_offset + sector * PROBE_SECTOR_SIZE,
+                            PROBE_SECTOR_SIZE)
+        if label[:len(LVM_LABEL_ID)] == LVM_LABEL_ID and label[
+                24:24 + len(LVM_LABEL_TYPE)] == LVM_LABEL_TYPE:
+            break
+    else:
+        return []
+    (pv_header_offset, ) = struct.unpack('<I', label[20:24])
+    # the PV UUID and device size are followed by zero terminated lists
+    # of data areas and metadata areas
+    locn_offset = pv_header_offset + 40
+    metadata_areas = []
+    for area_list in [[], metadata_areas]:
+        while True:
+            (area_offset, area_size) = struct.unpack(
+                '<QQ', label[locn_offset:locn_offset + 16])
+            locn_offset += 16
+            if not area_offset:
+                break
+            area_list.append((area_offset, area_size))
+    for (mda_offset, mda_size) in metadata_areas:
+        mda_header = reader.read(pv_offset + mda_offset, LVM_MDA_HEADER_SIZE)
+        if mda_header[4:4 + len(LVM_MDA_MAGIC)] != LVM_MDA_MAGIC:
+            continue
+        (text_offset, text_size) = struct.unpack('<QQ', mda_header[40:56])
+        if not text_size:
+            continue
+        text_start = pv_offset + mda_offset
+        if text_offset + text_size > mda_size:
+            wrapped = text_offset + text_size - mda_size
+            text = reader.read(text_start + text_offset,
+                               text_size - wrapped) + reader.read(
+                                   text_start + LVM_MDA_HEADER_SIZE, wrapped)
+        else:
+            text = reader.read(text_start + text_offset, text_size)
+        return lvm_metadata_paths(text.rstrip(b'\0').decode('utf-8'))
+    return []
+
+
+def lvm_metadata_paths(metadata):
+    """Logical volume device paths named in LVM2 metadata text"""
+    paths = []
+    vg_name = None
+    depth = 0
+    lv_depth = None
+    for line in metadata.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if line.endswith('{'):
+            section = line[:-1].strip()
+            if depth == 0:
+                vg_name = section
+            elif depth == 1 and section == 'logical_volumes':
+                lv_depth = depth + 1
+            elif depth == lv_depth:
+                paths.append("/dev/%s/%s" % (vg_name, section))
+            depth += 1
+        elif line.endswith('}'):
+            depth -= 1
+            if lv_depth is not None and depth < lv_depth:
+                lv_depth = None
+    return paths
+
+
+class TMOSImageSession(object):
+    """Single guestfs appliance attach used for all patching of a disk image
+
+    The drive is attached once to an appliance from the appliance pool, the
+    TMOS logical volumes are discovered and mounted side by side at their
+    TMOS mountpoints, every injection phase runs against the same handle,
+    and the disk is synced once on close.
+    Manifest entries for injected files are collected in memory and the
+    manifest is written once when the session closes. A readonly session
+    adds the drive read-only and mounts its file systems read-only. With a
+    patch state, each file system is synced and recorded as injected once
+    its tar stream is in, and is not injected again when patching resumes.
+    A resumed session leaves out staged files a stopped run already wrote.
+    """
+
+    def __init__(self, disk_image, drive=None, drive_format=None,
+                 manifest=True, readonly=False, state=None, resumed=False):
+        self.disk_image = disk_image
+        self.manifest = manifest
+        self.readonly = readonly
+        self.drive = drive or disk_image
+        self.drive_format = drive_format
+        self.gfs = None
+        self.devices = {}
+        self.mounted = False
+        self.staged = {}
+        self.state = state
+        self.resumed = resumed
+        self.manifest_entries = collections.OrderedDict()
+
+    def __enter__(self):
+        self.launch()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    @property
+    def is_tmos(self):
+        """A TMOS disk image always has a _config volume"""
+        return 'config' in self.devices
+
+    def has(self, file_system):
+        """Is the TMOS file system present in this disk image"""
+        return file_system in self.devices
+
+    def launch(self):
+        """Attach the drive to an appliance and discover TMOS file systems
+
+        Drives the image probe can read, and finds no TMOS _config volume
+        in, are not attached to an appliance at all.
+        """
+        if IMAGE_PROBE:
+            file_systems = probe_tmos_image(self.drive, self.drive_format)
+            if file_systems is not None and 'config' not in file_systems:
+                LOG.warn(
+                    '%s is not a TMOS image file.. skipping file injection..',
+                    self.disk_image)
+                return
+        drive_opts = {}
+        if self.drive_format:
+            drive_opts['format'] = self.drive_format
+        if self.readonly:
+            drive_opts['readonly'] = True
+        else:
+            drive_opts['discard'] = 'besteffort'
+        self.gfs = appliance_pool().attach(self.drive, drive_opts)
+        for file_system in self.gfs.list_filesystems():
+            for fs_name, fs_match in TMOS_FILESYSTEMS.items():
+                if fs_match in file_system:
+                    self.devices[fs_name] = file_system
+        if not self.is_tmos:
+            LOG.warn(
+                '%s is not a TMOS image file.. skipping file injection..',
+                self.disk_image)
+
+    def mount(self):
+        """Mount all discovered TMOS file systems at their mountpoints"""
+        if self.mounted:
+            return
+        for fs_name in self.devices:
+            try:
+                self.gfs.mkmountpoint(TMOS_MOUNTPOINTS[fs_name])
+            except RuntimeError:
+                # made by an earlier session in a hot-plug appliance
+                pass
+        for fs_name in self.devices:
+            LOG.debug('mounting %s at %s', self.devices[fs_name],
+                      TMOS_MOUNTPOINTS[fs_name])
+            if self.readonly:
+                self.gfs.mount_ro(self.devices[fs_name],
+                                  TMOS_MOUNTPOINTS[fs_name])
+            else:
+                self.gfs.mount(self.devices[fs_name],
+                               TMOS_MOUNTPOINTS[fs_name])
+        self.mounted = True
+
+    def inspect_files(self, paths):
+        """Size, mode and SHA-256 of image files, batched per directory
+
+        Files are stat'ed with one call per parent directory and only the
+        files asked for are checksummed, so no directory tree is hashed
+        to look up a few of its files. Missing files are left out of the
+        returned dictionary.
+        """
+        directories = collections.OrderedDict()
+        for path in paths:
+            directories.setdefault(os.path.dirname(path),
+                                   []).append(os.path.basename(path))
+        found = {}
+        for directory, names in directories.items():
+            if not self.gfs.is_dir(directory):
+                continue
+            stats = self.gfs.lstatnslist(directory, names)
+            for name, stat in zip(names, stats):
+                if stat['st_ino'] < 0:
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    checksum = self.gfs.checksum('sha256', path)
+                except RuntimeError as ex:
+                    LOG.warn('could not checksum %s: %s', path, ex)
+                    checksum = None
+                found[path] = {
+                    'size': stat['st_size'],
+                    'mode': "%04o" % (stat['st_mode'] & 0o7777),
+                    'uid': stat['st_uid'],
+                    'gid': stat['st_gid'],
+                    'sha256': checksum
+                }
+        return found
+
+    def stage(self, file_system, local, remote):
+        """Queue a local file for injection at an absolute image path"""
+        if file_system not in self.staged:
+            self.staged[file_system] = collections.OrderedDict()
+        self.staged[file_system][remote] = local
+
+    def add_manifest_entries(self, entries):
+        """Record files injected by an earlier session in this manifest"""
+        for entry in entries:
+            self.manifest_entries[entry['path']] = entry
+
+    def flush(self):
+        """Inject all staged files with one tar stream per file system
+
+        When resuming a stopped run, staged files already in the image
+        with the same content, mode and root ownership are left out of the
+        tar stream. Freshly extracted images and new overlays are not
+        looked up, as they cannot hold the staged files yet. Returns the
+        manifest entries of all staged files.
+        """
+        injected = []
+        if not any(self.staged.values()):
+            return injected
+        with report_phase('inject', self.disk_image):
+            for fs_name in TMOS_MOUNTPOINTS:
+                if not self.staged.get(fs_name):
+                    continue
+                mountpoint = TMOS_MOUNTPOINTS[fs_name]
+                staged_files = self.staged.pop(fs_name)
+                entries = [
+                    manifest_entry(fs_name, remote, local)
+                    for remote, local in staged_files.items()
+                ]
+                injected.extend(entries)
+                if self.state and self.state.done("injected:%s" % fs_name):
+                    LOG.info('files already injected into %s', mountpoint)
+                    continue
+                unchanged = set()
+                if self.resumed:
+                    unchanged = self.unchanged_paths(entries)
+                if unchanged:
+                    LOG.info('skipping %d unchanged files already in %s',
+                             len(unchanged), mountpoint)
+                    staged_files = collections.OrderedDict([
+                        (remote, local)
+                        for remote, local in staged_files.items()
+                        if remote not in unchanged
+                    ])
+                if staged_files:
+                    bundle_path = inject_tar_bundle(mountpoint, staged_files)
+                    report_count(bytes_written=os.path.getsize(bundle_path))
+                    LOG.debug(
+                        'injecting %d files into %s with one tar stream',
+                        len(staged_files), mountpoint)
+                    try:
+                        self.gfs.tar_in(bundle_path, mountpoint)
+                    finally:
+                        if not RUN_CACHE_DIR:
+                            os.remove(bundle_path)
+                if self.state:
+                    self.gfs.sync()
+                    self.state.record("injected:%s" % fs_name)
+        self.add_manifest_entries(injected)
+        return injected
+
+    def unchanged_paths(self, entries):
+        """Paths of manifest entries the image already holds unchanged"""
+        current = self.inspect_files([entry['path'] for entry in entries])
+        unchanged = set()
+        for entry in entries:
+            found = current.get(entry['path'])
+            if found and found['uid'] == 0 and found['gid'] == 0 and \
+                    found['size'] == entry['size'] and \
+                    found['mode'] == entry['mode'] and \
+                    found['sha256'] == entry['sha256']:
+                unchanged.add(entry['path'])
+        return unchanged
+
+    def sparsify(self, mode):
+        """Trim or zero free space in every mounted TMOS file system
+
+        Trimming discards free blocks through to the drive. Zeroing writes
+        zeros over free space, which qemu-img then skips when converting.
+        """
+        if not self.mounted or self.readonly or mode == 'none':
+            return
+        self.flush()
+        with report_phase('sparsify', self.disk_image):
+            for fs_name in self.devices:
+                mountpoint = TMOS_MOUNTPOINTS[fs_name]
+                if mode == 'zero':
+                    LOG.info('zeroing free space in %s', mountpoint)
+                    self.gfs.zero_free_space(mountpoint)
+                    continue
+                LOG.debug('trimming free space in %s', mountpoint)
+                try:
+                    self.gfs.fstrim(mountpoint)
+                except RuntimeError as ex:
+                    LOG.warn('could not trim free space in %s: %s',
+                             mountpoint, ex)
+
+    def close(self):
+        """Sync once and return the appliance to the pool"""
+        if not self.gfs:
+            return
+        self.flush()
+        if self.manifest and self.manifest_entries:
+            write_manifest(self.disk_image,
+                           list(self.manifest_entries.values()))
+        with report_phase('close', self.disk_image):
+            if not self.readonly:
+                self.gfs.sync()
+            appliance_pool().detach(self.gfs, self.mounted)
+        self.gfs = None
+        self.mounted = False
+
+
 def validate_tmos_device(disk_image):
     """Validate disk image has TMOS volumes"""
-    gfs = guestfs.GuestFS(python_return_dict=True)
-    gfs.add_drive_opts(disk_image)
-    gfs.launch()
-    is_tmos = False
-    config_dev = None
-    usr_dev = None
-    var_dev = None
-    shared_dev = None
-    for file_system in gfs.list_filesystems():
-        if '_config' in file_system:
-            is_tmos = True
-            config_dev = file_system
-        if '_usr' in file_system:
-            usr_dev = file_system
-        if '_var' in file_system:
-            var_dev = file_system
-        if 'share' in file_system:
-            shared_dev = file_system
-    if not is_tmos:
-        LOG.warn('%s is not a TMOS image file.. skipping file injection..',
-                 disk_image)
-    gfs.sync()
-    gfs.shutdown()
-    gfs.close()
-    wait_for_gfs(gfs)
-    return (is_tmos, config_dev, usr_dev, var_dev, shared_dev)
-
-
-def update_cloudinit_modules(tmos_cloudinit_dir):
-    """Get latest cloudinit"""
-    LOG.info('pulling latest cloudinit modules')
-    start_directory = os.getcwd()
-    os.chdir(tmos_cloudinit_dir)
-    gitout = subprocess.Popen("git pull", stdout=subprocess.PIPE,
-                              shell=True).communicate()[0].split('\n')
-    LOG.debug('git returned: %s', gitout)
-    os.chdir(start_directory)
+    with TMOSImageSession(disk_image) as session:
+        return (session.is_tmos, session.devices.get('config'),
+                session.devices.get('usr'), session.devices.get('var'),
+                session.devices.get('shared'))
+
+
+def update_cloudinit_modules(tmos_cloudinit_dir, revision=None):
+    """Get latest cloudinit, or check out a pinned revision
+
+    Returns False when a pinned revision could not be fetched or checked
+    out. A failed pull only leaves the current modules in place.
+    """
+    if revision:
+        LOG.info('checking out cloudinit modules revision %s', revision)
+        (returncode, gitout) = run_git(tmos_cloudinit_dir,
+                                       ['fetch', '--quiet', 'origin'])
+        if returncode != 0:
+            LOG.error('could not fetch cloudinit modules: %s', gitout)
+            return False
+        (returncode, gitout) = run_git(
+            tmos_cloudinit_dir, ['checkout', '--quiet', '--detach', revision])
+        if returncode != 0:
+            LOG.error('could not check out cloudinit modules revision %s: %s',
+                      revision, gitout)
+            return False
+    else:
+        LOG.info('pulling latest cloudinit modules')
+        (returncode, gitout) = run_git(tmos_cloudinit_dir, ['pull'])
+        if returncode != 0:
+            LOG.warn('could not pull latest cloudinit modules, patching '
+                     'with the modules already checked out: %s', gitout)
+    return True
+
+
+def run_git(repo_dir, git_args):
+    """Run a git command in a repository without changing directory"""
+    proc = subprocess.Popen(['git'] + git_args,
+                            cwd=repo_dir,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    gitout = proc.communicate()[0].decode('utf-8', 'replace')
+    LOG.debug('git returned: %s', gitout.split('\n'))
+    return (proc.returncode, gitout.strip())
+
+
+def git_revision(repo_dir):
+    """Commit currently checked out in a repository"""
+    try:
+        (returncode, revision) = run_git(repo_dir, ['rev-parse', 'HEAD'])
+    except OSError:
+        return None
+    if returncode != 0:
+        return None
+    return revision
 
 
 def replace_in_file(filePath, text, subs, flags=0):
@@ -379,184 +3160,364 @@ def replace_in_file(filePath, text, subs, flags=0):
         file.write(fileContents)
 
 
-def inject_cloudinit_modules(disk_image, tmos_cloudinit_dir, dev):
+def write_inject_tar(tar_stream, mountpoint, staged_files):
+    """Pack staged files into a tar stream relative to a mountpoint
+
+    File modes come from the local files, ownership is forced to root
+    just as a guestfs upload would have created it.
+    """
+    def root_owned(tarinfo):
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = 'root'
+        return tarinfo
+    tar = tarfile.open(fileobj=tar_stream, mode='w', format=tarfile.GNU_FORMAT)
+    for remote, local in staged_files.items():
+        arcname = remote[len(mountpoint):].lstrip('/')
+        LOG.debug('injecting %s to %s', os.path.basename(local), remote)
+        tar.add(local, arcname=arcname, recursive=False, filter=root_owned)
+    tar.close()
+    tar_stream.flush()
+
+
+def list_inject_files(inject_dir):
+    """List files in a local inject directory relative to its root
+
+    Each directory is walked once per run and the listing reused.
+    """
+    if inject_dir not in INJECT_FILE_INDEX:
+        inject_files = []
+        for root, dirs, files in os.walk(inject_dir):
+            dirs.sort()
+            for file_name in sorted(files):
+                inject_files.append(
+                    os.path.join(root, file_name)[len(inject_dir):])
+        INJECT_FILE_INDEX[inject_dir] = inject_files
+    return list(INJECT_FILE_INDEX[inject_dir])
+
+
+def inject_tar_bundle(mountpoint, staged_files):
+    """Tar bundle of staged files, built once per run and reused
+
+    Bundles in the run cache are named by a digest of the mountpoint and
+    the target path, mode and content of every file, so each image and
+    worker staging the same files injects the same tar file. Without a
+    run cache a temporary bundle is built which the caller removes.
+    """
+    if not RUN_CACHE_DIR:
+        (tar_fd, bundle_path) = tempfile.mkstemp(suffix='.tar')
+        with os.fdopen(tar_fd, 'wb') as tar_stream:
+            write_inject_tar(tar_stream, mountpoint, staged_files)
+        return bundle_path
+    bundle_key = hashlib.sha256(
+        json.dumps([mountpoint] + [[
+            remote, os.stat(local).st_mode,
+            local_file_sha256(local)
+        ] for remote, local in staged_files.items()]).encode('utf-8'))
+    bundle_path = os.path.join(RUN_CACHE_DIR,
+                               "%s.tar" % bundle_key.hexdigest())
+    if os.path.exists(bundle_path):
+        LOG.debug('reusing inject bundle %s for %s', bundle_path, mountpoint)
+        return bundle_path
+    (tar_fd, building_path) = tempfile.mkstemp(suffix='.building',
+                                               dir=RUN_CACHE_DIR)
+    with os.fdopen(tar_fd, 'wb') as tar_stream:
+        write_inject_tar(tar_stream, mountpoint, staged_files)
+    os.rename(building_path, bundle_path)
+    return bundle_path
+
+
+def image_python_version(session):
+    """The system python version of a TMOS disk image"""
+    if 'python2.7' in session.gfs.ls('/usr/lib'):
+        return 'python2.7'
+    return 'python2.6'
+
+
+def inject_cloudinit_modules(session, tmos_cloudinit_dir):
     """Inject cloudinit modules into TMOS disk image"""
-    gfs = guestfs.GuestFS(python_return_dict=True)
-    gfs.add_drive_opts(disk_image)
-    gfs.launch()
-    gfs.mount(dev, '/')
-    python_system_path = '/lib/python2.6'
-    if 'python2.7' in gfs.ls('/lib'):
-        python_system_path = '/lib/python2.7'
-    LOG.debug('injecting files into /usr%s' % python_system_path)
+    python_version = image_python_version(session)
+    python_system_path = "/usr/lib/%s" % python_version
+    LOG.debug('injecting files into %s' % python_system_path)
     tmos_cc_path = "%s/image_patch_files/system_python_path" % tmos_cloudinit_dir
-    tmos_cc_files = []
-    for root, dirs, files in os.walk(tmos_cc_path):
-        for file_name in files:
-            tmos_cc_files.append(
-                os.path.join(root, file_name)[len(tmos_cc_path):])
-    for tmos_cc_file in tmos_cc_files:
+    compiled = PYC_INDEX.get(python_version, {})
+    for tmos_cc_file in list_inject_files(tmos_cc_path):
         local = "%s%s" % (tmos_cc_path, tmos_cc_file)
         remote = "%s%s" % (python_system_path, tmos_cc_file)
-        LOG.debug('injecting %s to /usr%s', os.path.basename(local), remote)
-        mkdir_path = os.path.dirname(remote)
-        gfs.mkdir_p(mkdir_path)
-        gfs.upload(local, remote)
-        add_to_manifest("/usr%s" % remote, disk_image)
-    gfs.sync()
-    gfs.shutdown()
-    gfs.close()
-    wait_for_gfs(gfs)
-
-
-def inject_cloudinit_config_template(disk_image, tmos_cloudinit_dir,
-                                     cloud_template_file, dev):
+        session.stage('usr', local, remote)
+        if tmos_cc_file in compiled:
+            session.stage('usr', compiled[tmos_cc_file], "%sc" % remote)
+
+
+def precompile_cloudinit_modules(tmos_cloudinit_dir):
+    """Compile cloudinit modules to bytecode for each TMOS python version
+
+    TMOS cannot cache bytecode on its read-only /usr, so modules would
+    be compiled again on every boot. Each module is compiled by a local
+    interpreter of the same version as the image python, with the image
+    path recorded as the source file name. Versions without a local
+    interpreter are injected as source only.
+    """
+    tmos_cc_path = "%s/image_patch_files/system_python_path" % tmos_cloudinit_dir
+    modules = [
+        f for f in list_inject_files(tmos_cc_path) if f.endswith('.py')
+    ]
+    for python_version in TMOS_PYTHON_VERSIONS:
+        interpreter = find_executable(python_version)
+        if not interpreter:
+            LOG.info('no local %s interpreter, injecting %s modules as '
+                     'source only', python_version, python_version)
+            continue
+        pyc_dir = os.path.join(RUN_CACHE_DIR, 'pyc', python_version)
+        compile_args = []
+        for module in modules:
+            pyc_file = "%s%sc" % (pyc_dir, module)
+            if not os.path.exists(os.path.dirname(pyc_file)):
+                os.makedirs(os.path.dirname(pyc_file))
+            compile_args.extend([
+                "%s%s" % (tmos_cc_path, module), pyc_file,
+                "/usr/lib/%s%s" % (python_version, module)
+            ])
+        proc = subprocess.Popen([interpreter, '-c', PYC_COMPILE_SCRIPT] +
+                                compile_args,
+                                stderr=subprocess.PIPE)
+        errors = proc.communicate()[1].decode('utf-8', 'replace')
+        if errors:
+            LOG.warn('%s could not compile some modules: %s',
+                     python_version, errors.strip())
+        PYC_INDEX[python_version] = dict([
+            (module, "%s%sc" % (pyc_dir, module)) for module in modules
+            if os.path.exists("%s%sc" % (pyc_dir, module))
+        ])
+        LOG.info('precompiled %d cloudinit modules with %s',
+                 len(PYC_INDEX[python_version]), interpreter)
+
+
+def find_executable(name):
+    """Full path of an executable on the PATH"""
+    for path_dir in os.getenv('PATH', '').split(os.pathsep):
+        candidate = os.path.join(path_dir, name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def inject_cloudinit_config_template(session, cloud_template_file):
     """Inject cloudinit configuration template into TMOS disk image"""
     LOG.debug('injecting cloudinit configuration template %s' %
               cloud_template_file)
-    gfs = guestfs.GuestFS(python_return_dict=True)
-    gfs.add_drive_opts(disk_image)
-    gfs.launch()
-    gfs.mount(dev, '/')
-    mkdir_path = '/share/defaults/config/templates'
-    dest_template_file = "%s/cloud-init.tmpl" % mkdir_path
-    gfs.mkdir_p(mkdir_path)
-    gfs.upload(cloud_template_file, dest_template_file)
-    add_to_manifest("/usr%s" % dest_template_file, disk_image)
-    gfs.sync()
-    gfs.shutdown()
-    gfs.close()
-    wait_for_gfs(gfs)
-
-
-def inject_icontrollx_packages(disk_image, icontrollx_dir, dev):
+    dest_template_file = '/usr/share/defaults/config/templates/cloud-init.tmpl'
+    session.stage('usr', cloud_template_file, dest_template_file)
+
+
+def inject_icontrollx_packages(session, icontrollx_dir):
     """Inject iControl LX install packages into TMOS disk image"""
-    LOG.debug(
-        'injecting files from %s into /var/lib/cloud/icontrollx_installs' %
-        icontrollx_dir)
-    gfs = guestfs.GuestFS(python_return_dict=True)
-    gfs.add_drive_opts(disk_image)
-    gfs.launch()
-    gfs.mount(dev, '/')
-    package_files = []
-    for root, dirs, files in os.walk(icontrollx_dir):
-        for file_name in files:
-            package_files.append(
-                os.path.join(root, file_name)[len(icontrollx_dir):])
-    for package_file in package_files:
+    LOG.debug('injecting files from %s into %s' %
+              (icontrollx_dir, ICONTROLLX_INSTALL_DIR))
+    for package_file in list_inject_files(icontrollx_dir):
         if not package_file.startswith('/.'):
             local = "%s%s" % (icontrollx_dir, package_file)
-            remote = "/lib/cloud/icontrollx_installs%s" % package_file
-            LOG.debug('injecting %s to /var%s', os.path.basename(local),
-                      remote)
-            mkdir_path = os.path.dirname(remote)
-            gfs.mkdir_p(mkdir_path)
-            gfs.upload(local, remote)
-            add_to_manifest("/var%s" % remote, disk_image)
-    gfs.sync()
-    gfs.shutdown()
-    gfs.close()
-    wait_for_gfs(gfs)
-
-
-def inject_usr_files(disk_image, usr_dir, dev):
+            remote = "%s%s" % (ICONTROLLX_INSTALL_DIR, package_file)
+            session.stage('var', local, remote)
+    if ICONTROLLX_PREINSTALL:
+        preinstall_icontrollx_packages(session, icontrollx_dir)
+
+
+def icontrollx_preinstalls(icontrollx_dir):
+    """Unpack iControl LX RPM payloads once per run for preinstallation
+
+    Returns the unpack directory of each preinstallable package. Only
+    packages whose payload lies entirely under the iApps LX directory
+    are preinstalled. Other packages, and F5 Secure Installer files, are
+    left for the boot time installer. RPM scriptlets are not run, and the
+    packages are not recorded in the image RPM database.
+    """
+    if icontrollx_dir in ICONTROLLX_PREINSTALLS:
+        return ICONTROLLX_PREINSTALLS[icontrollx_dir]
+    preinstalls = collections.OrderedDict()
+    ICONTROLLX_PREINSTALLS[icontrollx_dir] = preinstalls
+    unpack_root = icontrollx_unpack_root(icontrollx_dir)
+    for package_file in list_inject_files(icontrollx_dir):
+        package_name = os.path.basename(package_file)
+        if package_file.startswith('/.') or not package_name.endswith(
+                '.rpm') or os.path.dirname(package_file) != '/':
+            continue
+        rpm_path = "%s%s" % (icontrollx_dir, package_file)
+        unpack_dir = os.path.join(unpack_root, package_name)
+        os.makedirs(unpack_dir)
+        LOG.info('unpacking iControl LX package %s for preinstallation',
+                 package_name)
+        rpm2cpio = subprocess.Popen([RPM2CPIO_CLI, rpm_path],
+                                    stdout=subprocess.PIPE)
+        cpio = subprocess.Popen([
+            CPIO_CLI, '-idm', '--quiet', '--no-absolute-filenames'
+        ],
+                                stdin=rpm2cpio.stdout,
+                                cwd=unpack_dir)
+        rpm2cpio.stdout.close()
+        cpio.communicate()
+        rpm2cpio.wait()
+        if rpm2cpio.returncode != 0 or cpio.returncode != 0:
+            LOG.warn('could not unpack %s, it will be installed at boot',
+                     package_name)
+            continue
+        payload = list_inject_files(unpack_dir)
+        outside = [
+            f for f in payload
+            if not f.startswith("%s/" % ICONTROLLX_IAPPS_DIR)
+        ]
+        if not payload or outside:
+            LOG.warn('%s installs files outside %s, it will be installed at '
+                     'boot', package_name, ICONTROLLX_IAPPS_DIR)
+            continue
+        preinstalls[package_name] = unpack_dir
+    if preinstalls:
+        enable_file = os.path.join(unpack_root, 'enable')
+        open(enable_file, 'w').close()
+        preinstalled_file = os.path.join(unpack_root, 'preinstalled.json')
+        with open(preinstalled_file, 'w') as preinstalled:
+            json.dump(dict([
+                (package_name, {
+                    'sha256': local_file_sha256(
+                        os.path.join(icontrollx_dir, package_name))
+                }) for package_name in preinstalls
+            ]), preinstalled, indent=4, sort_keys=True)
+    return preinstalls
+
+
+def icontrollx_unpack_root(icontrollx_dir):
+    """Run cache directory holding the unpacked packages of one directory"""
+    return os.path.join(
+        RUN_CACHE_DIR, 'icontrollx',
+        hashlib.sha256(
+            os.path.abspath(icontrollx_dir).encode('utf-8')).hexdigest())
+
+
+def preinstall_icontrollx_packages(session, icontrollx_dir):
+    """Stage unpacked iControl LX packages into the iApps LX directory"""
+    preinstalls = icontrollx_preinstalls(icontrollx_dir)
+    if not preinstalls:
+        return
+    unpack_root = icontrollx_unpack_root(icontrollx_dir)
+    for package_name, unpack_dir in preinstalls.items():
+        LOG.debug('preinstalling iControl LX package %s', package_name)
+        for payload_file in list_inject_files(unpack_dir):
+            session.stage('var', "%s%s" % (unpack_dir, payload_file),
+                          payload_file)
+    session.stage('var', os.path.join(unpack_root, 'enable'),
+                  "%s/enable" % ICONTROLLX_IAPPS_DIR)
+    session.stage('var', os.path.join(unpack_root, 'preinstalled.json'),
+                  ICONTROLLX_PREINSTALLED_FILE)
+
+
+def inject_files(session, file_system, inject_dir):
+    """Patch a mounted file system of a TMOS disk image from a local directory"""
+    mountpoint = TMOS_MOUNTPOINTS[file_system]
+    LOG.debug('injecting files into %s' % mountpoint)
+    for inject_file in list_inject_files(inject_dir):
+        local = "%s%s" % (inject_dir, inject_file)
+        remote = "%s%s" % (mountpoint, inject_file)
+        session.stage(file_system, local, remote)
+
+
+def inject_platform_defaults(session, platform_defaults_file):
+    """Bake platform defaults into the TMOS root and config file systems
+
+    The /PLATFORM file is written to the root file system and BigDB
+    variables are set in the image's /config/BigDB.dat, so they are in
+    place before mcpd first starts instead of being set at boot. The
+    defaults are also written as JSON next to the cloudinit modules, for
+    the modules to restore any value missing at boot.
+    """
+    defaults = load_platform_defaults(platform_defaults_file)
+    defaults_dir = tempfile.mkdtemp(prefix='platform_', dir=RUN_CACHE_DIR)
+    if session.has('usr'):
+        defaults_json = os.path.join(defaults_dir, 'platform_defaults.json')
+        with open(defaults_json, 'w') as defaults_out:
+            json.dump(defaults, defaults_out, indent=4, sort_keys=True)
+        os.chmod(defaults_json, 0o644)
+        session.stage(
+            'usr', defaults_json, "/usr/lib/%s%s" %
+            (image_python_version(session), PLATFORM_DEFAULTS_MODULE_FILE))
+    if defaults.get('platform'):
+        if session.has('root'):
+            platform_file = os.path.join(defaults_dir, 'PLATFORM')
+            with open(platform_file, 'w') as platform:
+                platform.write(defaults['platform'])
+            os.chmod(platform_file, 0o644)
+            LOG.debug('baking %s platform defaults into %s',
+                      platform_defaults_file, PLATFORM_FILE)
+            session.stage(
+                'root', platform_file,
+                "%s%s" % (TMOS_MOUNTPOINTS['root'], PLATFORM_FILE))
+        else:
+            LOG.warn('no TMOS root file system found to write %s',
+                     PLATFORM_FILE)
+    if defaults['db'] and session.has('config'):
+        bigdb = ''
+        bigdb_mode = 0o644
+        if session.gfs.is_file(BIGDB_FILE):
+            bigdb = session.gfs.read_file(BIGDB_FILE).decode('utf-8')
+            bigdb_mode = session.gfs.lstatns(BIGDB_FILE)['st_mode'] & 0o7777
+        bigdb_file = os.path.join(defaults_dir, 'BigDB.dat')
+        with open(bigdb_file, 'w') as bigdb_out:
+            bigdb_out.write(set_bigdb_values(bigdb, defaults['db']))
+        os.chmod(bigdb_file, bigdb_mode)
+        LOG.debug('baking BigDB variables %s into %s',
+                  ', '.join(defaults['db'].keys()), BIGDB_FILE)
+        session.stage('config', bigdb_file, BIGDB_FILE)
+
+
+def set_bigdb_values(bigdb, db_values):
+    """Set variable values in BigDB.dat contents
+
+    Each variable is a [section] with a value= line. Section names are
+    matched without regard to case. Missing sections are added with the
+    variable name as given, and missing value lines are added.
+    """
+    lines = bigdb.splitlines()
+    for (db_key, db_value) in db_values.items():
+        section_start = None
+        for (index, line) in enumerate(lines):
+            if line.strip().lower() == "[%s]" % db_key.lower():
+                section_start = index
+                break
+        if section_start is None:
+            if lines and lines[-1].strip():
+                lines.append('')
+            lines.extend(["[%s]" % db_key, "value=%s" % db_value])
+            continue
+        section_end = len(lines)
+        for index in range(section_start + 1, len(lines)):
+            if lines[index].strip().startswith('['):
+                section_end = index
+                break
+        for index in range(section_start + 1, section_end):
+            if lines[index].strip().lower().startswith('value='):
+                lines[index] = "value=%s" % db_value
+                break
+        else:
+            lines.insert(section_start + 1, "value=%s" % db_value)
+    return "%s\n" % '\n'.join(lines)
+
+
+def inject_usr_files(session, usr_dir):
     """Patch /usr file system of a TMOS disk image"""
-    LOG.debug('injecting files into /usr')
-    gfs = guestfs.GuestFS(python_return_dict=True)
-    gfs.add_drive_opts(disk_image)
-    gfs.launch()
-    gfs.mount(dev, '/')
-    usr_files = []
-    for root, dirs, files in os.walk(usr_dir):
-        for file_name in files:
-            usr_files.append(os.path.join(root, file_name)[len(usr_dir):])
-    for usr_file in usr_files:
-        local = "%s%s" % (usr_dir, usr_file)
-        LOG.debug('injecting %s to /usr%s', os.path.basename(local), usr_file)
-        mkdir_path = os.path.dirname(usr_file)
-        gfs.mkdir_p(mkdir_path)
-        gfs.upload(local, usr_file)
-        add_to_manifest("/usr%s" % usr_file, disk_image)
-    gfs.sync()
-    gfs.shutdown()
-    gfs.close()
-    wait_for_gfs(gfs)
-
-
-def inject_var_files(disk_image, var_dir, dev):
+    inject_files(session, 'usr', usr_dir)
+
+
+def inject_var_files(session, var_dir):
     """Patch /var file system of a TMOS disk image"""
-    LOG.debug('injecting files into /var')
-    gfs = guestfs.GuestFS(python_return_dict=True)
-    gfs.add_drive_opts(disk_image)
-    gfs.launch()
-    gfs.mount(dev, '/')
-    var_files = []
-    for root, dirs, files in os.walk(var_dir):
-        for file_name in files:
-            var_files.append(os.path.join(root, file_name)[len(var_dir):])
-    for var_file in var_files:
-        local = "%s%s" % (var_dir, var_file)
-        LOG.debug('injecting %s to /var%s', os.path.basename(local), var_file)
-        mkdir_path = os.path.dirname(var_file)
-        gfs.mkdir_p(mkdir_path)
-        gfs.upload(local, var_file)
-        add_to_manifest("/var%s" % var_file, disk_image)
-    gfs.sync()
-    gfs.shutdown()
-    gfs.close()
-    wait_for_gfs(gfs)
-
-
-def inject_shared_files(disk_image, shared_dir, dev):
+    inject_files(session, 'var', var_dir)
+
+
+def inject_shared_files(session, shared_dir):
     """Patch /shared file system of a TMOS disk image"""
-    LOG.debug('injecting files into /shared')
-    gfs = guestfs.GuestFS(python_return_dict=True)
-    gfs.add_drive_opts(disk_image)
-    gfs.launch()
-    gfs.mount(dev, '/')
-    shared_files = []
-    for root, dirs, files in os.walk(shared_dir):
-        for file_name in files:
-            shared_files.append(
-                os.path.join(root, file_name)[len(shared_dir):])
-    for shared_file in shared_files:
-        local = "%s%s" % (shared_dir, shared_file)
-        LOG.debug('injecting %s to /shared%s', os.path.basename(local),
-                  shared_file)
-        mkdir_path = os.path.dirname(shared_file)
-        gfs.mkdir_p(mkdir_path)
-        gfs.upload(local, shared_file)
-        add_to_manifest("/shared%s" % shared_file, disk_image)
-    gfs.sync()
-    gfs.shutdown()
-    gfs.close()
-    wait_for_gfs(gfs)
-
-
-def inject_config_files(disk_image, config_dir, dev):
+    inject_files(session, 'shared', shared_dir)
+
+
+def inject_config_files(session, config_dir):
     """Patch /config file system of a TMOS disk image"""
-    LOG.debug('injecting files into /config')
-    gfs = guestfs.GuestFS(python_return_dict=True)
-    gfs.add_drive_opts(disk_image)
-    gfs.launch()
-    gfs.mount(dev, '/')
-    config_files = []
-    for root, dirs, files in os.walk(config_dir):
-        for file_name in files:
-            config_files.append(
-                os.path.join(root, file_name)[len(config_dir):])
-    for config_file in config_files:
-        local = "%s%s" % (config_dir, config_file)
-        LOG.debug('injecting %s to /config%s', os.path.basename(local),
-                  config_file)
-        mkdir_path = os.path.dirname(config_file)
-        gfs.mkdir_p(mkdir_path)
-        gfs.upload(local, config_file)
-        add_to_manifest("/config%s" % config_file, disk_image)
-    gfs.sync()
-    gfs.shutdown()
-    gfs.close()
-    wait_for_gfs(gfs)
+    inject_files(session, 'config', config_dir)
 
 
 if __name__ == "__main__":
@@ -585,12 +3546,54 @@ if __name__ == "__main__":
     PRIVATE_PEM_KEY_FILE = os.getenv('PRIVATE_PEM_KEY_FILE', None)
     TMOS_CLOUDINIT_CONFIG_TEMPLATE = os.getenv(
         'TMOS_CLOUDINIT_CONFIG_TEMPLATE', None)
+    PATCH_WORKERS = int(os.getenv('PATCH_WORKERS', '1'))
+    PATCH_OVERLAY = os.getenv('PATCH_OVERLAY', 'false').lower() in [
+        '1', 'yes', 'true'
+    ]
+    TMOS_BUILD_MATRIX = os.getenv('TMOS_BUILD_MATRIX', None)
+    TMOS_CLOUDINIT_REVISION = os.getenv('TMOS_CLOUDINIT_REVISION', None)
+    TMOS_PLATFORM_DEFAULTS = os.getenv('TMOS_PLATFORM_DEFAULTS', None)
+    ICONTROLLX_PREINSTALL = os.getenv('ICONTROLLX_PREINSTALL',
+                                      'false').lower() in ['1', 'yes', 'true']
+    VMDK_CONVERTER = os.getenv('VMDK_CONVERTER', 'auto').lower()
+    QEMU_IMG_COROUTINES = int(os.getenv('QEMU_IMG_COROUTINES', '8'))
+    IMAGE_SPARSIFY = os.getenv('IMAGE_SPARSIFY', 'trim').lower()
+    QCOW2_COMPRESS = os.getenv('QCOW2_COMPRESS', 'true').lower() in [
+        '1', 'yes', 'true'
+    ]
+    OUTPUT_FORMATS = [
+        f.strip().lower()
+        for f in os.getenv('OUTPUT_FORMATS', '').split(',') if f.strip()
+    ]
+    PATCH_WORKER_MEMORY = int(
+        os.getenv('PATCH_WORKER_MEMORY_MB', '1536')) * 1024 * 1024
+    BLOCK_DELTA = os.getenv('BLOCK_DELTA', 'false').lower() in [
+        '1', 'yes', 'true'
+    ]
+    PATCHER_MODE = os.getenv('PATCHER_MODE', 'patch').lower()
+    VERIFY_WORKERS = int(os.getenv('VERIFY_WORKERS', '4'))
+    VERIFY_REPORT = os.getenv('VERIFY_REPORT', None)
+    BUILD_REPORT = os.getenv('BUILD_REPORT', None)
+    APPLIANCE_POOL_MODE = os.getenv('APPLIANCE_POOL', 'auto').lower()
+    IMAGE_PROBE = os.getenv('IMAGE_PROBE', 'true').lower() in [
+        '1', 'yes', 'true'
+    ]
+    FIXED_APPLIANCE_DIR = os.getenv('FIXED_APPLIANCE_DIR',
+                                    FIXED_APPLIANCE_DIR)
     if len(sys.argv) > 1:
         TMOS_IMAGE_DIR = sys.argv[1]
     if len(sys.argv) > 2:
         TMOS_CLOUDINIT_DIR = sys.argv[2]
+    if APPLIANCE_POOL_MODE not in ['auto', 'fixed', 'none']:
+        LOG.error('APPLIANCE_POOL must be one of auto, fixed or none')
+        sys.exit(1)
     if TMOS_IMAGE_DIR:
         LOG.info("Scanning for images in: %s", TMOS_IMAGE_DIR)
+    if PATCHER_MODE == 'verify':
+        REPORT = verify_images(TMOS_IMAGE_DIR, VERIFY_WORKERS, VERIFY_REPORT)
+        if not REPORT['passed']:
+            sys.exit(1)
+        sys.exit(0)
     if TMOS_CLOUDINIT_DIR:
         LOG.info("TMOS cloudinit modules sourced from: %s", TMOS_CLOUDINIT_DIR)
     if TMOS_ICONTROLLX_DIR:
@@ -622,11 +3625,39 @@ if __name__ == "__main__":
     if TMOS_CLOUDINIT_CONFIG_TEMPLATE:
         LOG.info('cloudinit configuration template: %s' %
                  TMOS_CLOUDINIT_CONFIG_TEMPLATE)
-    patch_images(TMOS_IMAGE_DIR, TMOS_CLOUDINIT_DIR, TMOS_USR_INJECT_DIR,
-                 TMOS_VAR_INJECT_DIR, TMOS_CONFIG_INJECT_DIR,
-                 TMOS_SHARED_INJECT_DIR, TMOS_ICONTROLLX_DIR, PRIVATE_KEY_PATH,
-                 TMOS_CLOUDINIT_CONFIG_TEMPLATE, IMAGE_OVERWRITE,
-                 IMAGE_BUILD_ID)
+    if PATCH_WORKERS > 1:
+        LOG.info('patching with up to %d concurrent workers', PATCH_WORKERS)
+    if PATCH_OVERLAY:
+        LOG.info('patching qcow2 overlays of pristine extracted images')
+    if TMOS_BUILD_MATRIX:
+        LOG.info('patching build matrix variants from: %s', TMOS_BUILD_MATRIX)
+    if ICONTROLLX_PREINSTALL:
+        LOG.info('preinstalling iControl LX packages into patched images')
+    if TMOS_PLATFORM_DEFAULTS:
+        LOG.info('baking platform defaults from: %s', TMOS_PLATFORM_DEFAULTS)
+    if IMAGE_SPARSIFY not in ['trim', 'zero', 'none']:
+        LOG.error('IMAGE_SPARSIFY must be one of trim, zero or none')
+        sys.exit(1)
+    for OUTPUT_FORMAT in OUTPUT_FORMATS:
+        if ".%s" % OUTPUT_FORMAT not in IMAGE_TYPES:
+            LOG.error('unsupported output format %s', OUTPUT_FORMAT)
+            sys.exit(1)
+    if OUTPUT_FORMATS:
+        LOG.info('writing additional output formats: %s',
+                 ', '.join(OUTPUT_FORMATS))
+    if BLOCK_DELTA:
+        if PATCH_OVERLAY or TMOS_BUILD_MATRIX:
+            LOG.info('writing block deltas against the pristine images')
+        else:
+            LOG.warn('BLOCK_DELTA needs PATCH_OVERLAY or TMOS_BUILD_MATRIX, '
+                     'no block deltas will be written')
+    FAILED = patch_images(
+        TMOS_IMAGE_DIR, TMOS_CLOUDINIT_DIR, TMOS_USR_INJECT_DIR,
+        TMOS_VAR_INJECT_DIR, TMOS_CONFIG_INJECT_DIR, TMOS_SHARED_INJECT_DIR,
+        TMOS_ICONTROLLX_DIR, PRIVATE_KEY_PATH, TMOS_CLOUDINIT_CONFIG_TEMPLATE,
+        IMAGE_OVERWRITE, IMAGE_BUILD_ID, PATCH_WORKERS, PATCH_OVERLAY,
+        TMOS_BUILD_MATRIX, TMOS_CLOUDINIT_REVISION, TMOS_PLATFORM_DEFAULTS,
+        BUILD_REPORT)
     STOP_TIME = time.time()
     DURATION = STOP_TIME - START_TIME
     DURATION = str(datetime.timedelta(seconds=DURATION))
@@ -634,3 +3665,7 @@ if __name__ == "__main__":
         'process end time: %s - ran %s',
         datetime.datetime.fromtimestamp(STOP_TIME).strftime(
             "%A, %B %d, %Y %I:%M:%S"), DURATION)
+    if FAILED:
+        LOG.error('%d archives failed to patch: %s', len(FAILED),
+                  ', '.join(FAILED))
+        sys.exit(1)